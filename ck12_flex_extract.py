@@ -1,5 +1,7 @@
 import glob
+import io
 import json
+import os
 import functools
 import string
 import re
@@ -13,16 +15,10 @@ import fuzzywuzzy.fuzz
 import jsonschema
 import ck12_schema
 import warnings
-import klepto
 
-from pdfminer.pdfparser import PDFParser
-from pdfminer.pdfdocument import PDFDocument
-from pdfminer.pdfpage import PDFPage
-from pdfminer.pdfinterp import PDFResourceManager
-from pdfminer.pdfinterp import PDFPageInterpreter
 from pdfminer.layout import LAParams
-from pdfminer.converter import PDFPageAggregator
-from pdfminer.layout import LTFigure
+
+from page_layouts import iter_page_layouts, iter_figure_layouts, get_page_mediabox, PopplerPageIndex, LayoutCache
 
 
 class QuestionTypeParser(object):
@@ -320,7 +316,7 @@ class CK12QuizParser(object):
 
 class FlexbookParser(object):
 
-    def __init__(self, rasterized_pages_dir=None, figure_dest_dir=None):
+    def __init__(self, rasterized_pages_dir=None, figure_dest_dir=None, layout_cache_dir=None, raster_cache_dir=None):
         self.current_lesson = None
         self.current_topic = None
         self.current_topic_number = 1
@@ -334,6 +330,12 @@ class FlexbookParser(object):
         self.list_separator = '\n'
         self.line_separator = ' '
         self.page_vertical_dim = None
+        self.layout_workers = 1
+        self.layout_cache = LayoutCache(layout_cache_dir) if layout_cache_dir else None
+        self.raster_cache_dir = raster_cache_dir
+        self.raster_cache = None
+        self.raster_dpi = 150
+        self.current_pdf = None
         self.file_paths = {
             'rasterized_page_dir': rasterized_pages_dir,
             'cropped_fig_dest_dir': figure_dest_dir
@@ -351,53 +353,71 @@ class FlexbookParser(object):
         text = text.encode('ascii', 'ignore').lstrip().strip()
         return text
 
+    def iter_page_layouts(self, pdf_file, page_range, line_overlap,
+                          char_margin,
+                          line_margin,
+                          word_margin,
+                          boxes_flow,
+                          as_tables=False):
+        laparams = LAParams(line_overlap, char_margin, line_margin, word_margin, boxes_flow)
+        if page_range and not self.page_vertical_dim:
+            self.page_vertical_dim = get_page_mediabox(pdf_file, page_range[0], self.layout_cache)[-1]
+        return iter_page_layouts(pdf_file, page_range, laparams, self.layout_workers, cache=self.layout_cache,
+                                 as_tables=as_tables)
+
     def make_page_layouts(self, pdf_file, page_range, line_overlap,
                           char_margin,
                           line_margin,
                           word_margin,
-                          boxes_flow):
-        stored_layouts = klepto.archives.dir_archive('persist_pdf_layouts', serialized=True, cached=False)
-        db_key = pdf_file.split('/')[-1] + '_' + str(page_range[0]) + '_' + str(page_range[1])
-        # this will break image size when extracting figs
-        if db_key in stored_layouts.keys() and False:
-            page_layouts = stored_layouts[db_key]
-        else:
-            laparams = LAParams(line_overlap, char_margin, line_margin, word_margin, boxes_flow)
-            page_layouts = []
-            with open(pdf_file, 'r') as fp:
-                parser = PDFParser(fp)
-                document = PDFDocument(parser)
-                rsrcmgr = PDFResourceManager()
-                device = PDFPageAggregator(rsrcmgr, laparams=laparams)
-                interpreter = PDFPageInterpreter(rsrcmgr, device)
-                for page_n, page in enumerate(PDFPage.create_pages(document)):
-                    if not page_range:
-                        interpreter.process_page(page)
-                        layout = device.get_result()
-                        page_layouts.append(layout)
-                    elif page_range[0] <= page_n <= page_range[1]:
-                        interpreter.process_page(page)
-                        layout = device.get_result()
-                        page_layouts.append(layout)
-                        if not self.page_vertical_dim:
-                            self.page_vertical_dim = page.mediabox[-1]
-            stored_layouts[db_key] = page_layouts
-        return page_layouts
+                          boxes_flow,
+                          as_tables=False):
+        return [layout for _, layout in self.iter_page_layouts(pdf_file, page_range, line_overlap, char_margin,
+                                                               line_margin, word_margin, boxes_flow, as_tables)]
+
+    def iter_page_figures(self, pdf_file, page_range):
+        if page_range and not self.page_vertical_dim:
+            self.page_vertical_dim = get_page_mediabox(pdf_file, page_range[0], self.layout_cache)[-1]
+        return iter_figure_layouts(pdf_file, page_range, cache=self.layout_cache)
+
+    def get_raster_cache(self):
+        # page_rasters imports Wand, which only the parsers that render pages need
+        from page_rasters import RasterCache
+        if self.raster_cache is None:
+            self.raster_cache = RasterCache(self.raster_cache_dir)
+        return self.raster_cache
+
+    def rasterize_pdf(self, file_path, page_ranges=None):
+        if not self.raster_cache_dir:
+            raise ValueError('rasterize_pdf needs a parser made with a raster_cache_dir')
+        from page_rasters import rasterize_pages
+        return rasterize_pages(file_path, page_ranges, self.raster_dpi, self.get_raster_cache(), self.layout_workers)
+
+    def open_page_image(self, page_n):
+        """
+        Opens the pre-rendered pg_XXXX.pdf.png of a page in rasterized_pages_dir when there is one, otherwise a render
+        of the current pdf, kept in the raster cache when the parser has a raster_cache_dir.
+        """
+        if self.file_paths['rasterized_page_dir']:
+            image_path = self.file_paths['rasterized_page_dir'] + 'pg_' + str(page_n + 1).zfill(4) + '.pdf.png'
+            if os.path.isfile(image_path):
+                return Image.open(image_path)
+        if self.raster_cache_dir:
+            return Image.open(self.get_raster_cache().page_path(self.current_pdf, page_n, self.raster_dpi))
+        from page_rasters import render_page
+        return Image.open(io.BytesIO(render_page(self.current_pdf, page_n, self.raster_dpi)))
 
     def parse_pdf(self, file_path, page_ranges=None, extracting_answer_key=False):
         doc = pdf_poppler.Document(file_path)
-        page_layouts = self.make_page_layouts(file_path, page_ranges, word_margin=0.1, line_overlap=0.5,
-                                              char_margin=2.0, line_margin=0.5, boxes_flow=0.5)
-
+        self.current_pdf = file_path
+        page_index = PopplerPageIndex(doc)
         if not page_ranges:
-            page_ranges = [0, doc.no_of_pages()]
-        for idx, page in enumerate(doc):
-            if page_ranges[0] < idx <= page_ranges[1]:
-                page_figures = []
-                for layout_ob in page_layouts[idx - page_ranges[0]]:
-                    if isinstance(layout_ob, LTFigure):
-                        page_figures.append(layout_ob.bbox)
-                self.extract_page_text(idx, page, page_figures, file_path.split('/')[-1], extracting_answer_key)
+            page_ranges = [0, len(page_index)]
+        page_layouts = self.iter_page_figures(file_path, page_ranges)
+        for idx, page_layout in page_layouts:
+            if page_ranges[0] < idx < len(page_index):
+                page = page_index.get_page(idx)
+                self.extract_page_text(idx, page, page_layout.figure_bbox_list(), file_path.split('/')[-1],
+                                       extracting_answer_key)
         return self.filter_categories()
 
     def filter_categories(self):
@@ -410,13 +430,11 @@ class FlexbookParser(object):
         return self.parsed_content
 
     def crop_and_extract_figure(self, page_n, fig_n, rectangle, extract_images=False):
-        page_image_filename = 'pg_' + str(page_n + 1).zfill(4) + '.pdf.png'
-        image_path = self.file_paths['rasterized_page_dir'] + page_image_filename
         cropped_image_path = self.file_paths['cropped_fig_dest_dir'] + self.current_lesson + '_' + self.current_topic + \
                              '_' + str(page_n + 1).zfill(4) + '_fig_' + fig_n + '.png'
         cropped_image_path = cropped_image_path.replace(' ', '_')
         if extract_images:
-            page_image = Image.open(image_path)
+            page_image = self.open_page_image(page_n)
             scale_factor = float(page_image.size[1]) / float(self.page_vertical_dim)
             scaled_box = [co * scale_factor for co in rectangle]
             temp = page_image.size[1] - scaled_box[3]
@@ -511,8 +529,8 @@ class FlexbookParser(object):
 
 
 class WorkbookParser(FlexbookParser):
-    def __init__(self):
-        super(WorkbookParser, self).__init__()
+    def __init__(self, layout_cache_dir=None, raster_cache_dir=None):
+        super(WorkbookParser, self).__init__(layout_cache_dir=layout_cache_dir, raster_cache_dir=raster_cache_dir)
         self.sections_to_keep = ['True or False', 'Multiple Choice', 'Matching', 'Fill in the Blank']
         self.section_demarcations = {
             'topic_color': (0.811767578125, 0.3411712646484375, 0.149017333984375),
@@ -889,8 +907,8 @@ class MatchingParser(WorkbookQuestionParser):
 
 
 class QuizTestParser(WorkbookParser):
-    def __init__(self):
-        super(QuizTestParser, self).__init__()
+    def __init__(self, layout_cache_dir=None, raster_cache_dir=None):
+        super(QuizTestParser, self).__init__(layout_cache_dir=layout_cache_dir, raster_cache_dir=raster_cache_dir)
         self.sections_to_keep = ['True or False', 'Multiple Choice', 'Matching', 'Fill in the Blanks', 'Fill in the Blank']
         self.sections_to_ignore = ['Short Answer']
         self.section_demarcations = {
@@ -1018,8 +1036,8 @@ class QuizTestParser(WorkbookParser):
 
 class TextbookParser(FlexbookParser):
 
-    def __init__(self, overlap_tol=None, blank_threshold=None):
-        super(TextbookParser, self).__init__(overlap_tol, blank_threshold)
+    def __init__(self, overlap_tol=None, blank_threshold=None, layout_cache_dir=None, raster_cache_dir=None):
+        super(TextbookParser, self).__init__(overlap_tol, blank_threshold, layout_cache_dir, raster_cache_dir)
 
     def restructure_parsed_content(self, pdf_path):
         local_path = '../flexbook_image_extraction/figures/'
@@ -1048,8 +1066,9 @@ class TextbookParser(FlexbookParser):
 
 
 class GradeSchoolFlexbookParser(TextbookParser):
-    def __init__(self, rasterized_pages_dir=None, figure_dest_dir=None):
-        super(GradeSchoolFlexbookParser, self).__init__(rasterized_pages_dir, figure_dest_dir)
+    def __init__(self, rasterized_pages_dir=None, figure_dest_dir=None, layout_cache_dir=None, raster_cache_dir=None):
+        super(GradeSchoolFlexbookParser, self).__init__(rasterized_pages_dir, figure_dest_dir, layout_cache_dir,
+                                                        raster_cache_dir)
         self.line_sep_tol = 10
         self.section_demarcations = {
             'topic_color': (0.811767578125, 0.3411712646484375, 0.149017333984375),
@@ -1104,8 +1123,8 @@ class GradeSchoolFlexbookParser(TextbookParser):
 
 class LessonParser(TextbookParser):
 
-    def __init__(self, overlap_tol=None, blank_threshold=None):
-        super(LessonParser, self).__init__(overlap_tol, blank_threshold)
+    def __init__(self, overlap_tol=None, blank_threshold=None, layout_cache_dir=None, raster_cache_dir=None):
+        super(LessonParser, self).__init__(overlap_tol, blank_threshold, layout_cache_dir, raster_cache_dir)
         self.section_demarcations = {
             'topic_color': (0.811767578125, 0.3411712646484375, 0.149017333984375),
             'lesson_size': 26.8989,
@@ -1282,8 +1301,9 @@ class CK12DataSetAssembler(object):
 
 class VocabDefinitionParser(FlexbookParser):
 
-    def __init__(self, rasterized_pages_dir=None, figure_dest_dir=None):
-        super(VocabDefinitionParser, self).__init__(rasterized_pages_dir, figure_dest_dir)
+    def __init__(self, rasterized_pages_dir=None, figure_dest_dir=None, layout_cache_dir=None, raster_cache_dir=None):
+        super(VocabDefinitionParser, self).__init__(rasterized_pages_dir, figure_dest_dir, layout_cache_dir,
+                                                    raster_cache_dir)
         self.line_sep_tol = 10
         self.current_word = None
         self.parsed_content = defaultdict(str)
@@ -0,0 +1,169 @@
+import os
+import random
+import re
+import hashlib
+import tempfile
+import zlib
+import cPickle as pickle
+
+
+file_digests = {}
+
+ENTRY_DIGEST = re.compile(r'[0-9a-f]{40}$')
+
+
+def file_digest(file_path, block_size=1 << 20):
+    """
+    sha1 of a file's contents, remembered per path for as long as the file's size and mtime are unchanged.
+    :param file_path: path to hash
+    :param block_size: bytes read at a time
+    :return: hex digest string
+    """
+    stat = os.stat(file_path)
+    memo_key = (os.path.abspath(file_path), stat.st_size, stat.st_mtime)
+    if memo_key not in file_digests:
+        digest = hashlib.sha1()
+        with open(file_path, 'rb') as f:
+            for block in iter(lambda: f.read(block_size), b''):
+                digest.update(block)
+        file_digests[memo_key] = digest.hexdigest()
+    return file_digests[memo_key]
+
+
+def bytes_digest(data):
+    return hashlib.sha1(data).hexdigest()
+
+
+class DiskCache(object):
+    """
+    Directory of cache entries named by the sha1 of their key, evicted least recently used first once the
+    directory grows past max_bytes. Entries are written atomically so several processes can share one cache.
+    The directory is only created by the first put. Each instance keeps a running estimate of the cache's size,
+    taken from a sample of its subdirectories and refreshed every estimate_every puts, so only a cache that looks
+    over budget pays for a full scan.
+    """
+
+    estimate_every = 64
+
+    def __init__(self, cache_dir, max_bytes=2 * 1024 ** 3, entry_ext='.bin'):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.entry_ext = entry_ext
+        self.total_bytes = None
+        self.puts_since_estimate = 0
+
+    def entry_subdirs(self):
+        try:
+            subdir_names = os.listdir(self.cache_dir)
+        except OSError:
+            return []
+        return [subdir_name for subdir_name in subdir_names
+                if len(subdir_name) == 2 and os.path.isdir(os.path.join(self.cache_dir, subdir_name))]
+
+    def subdir_entry_paths(self, subdir_name):
+        subdir = os.path.join(self.cache_dir, subdir_name)
+        try:
+            file_names = os.listdir(subdir)
+        except OSError:
+            return
+        for file_name in file_names:
+            digest, ext = os.path.splitext(file_name)
+            if ext == self.entry_ext and digest[:2] == subdir_name and ENTRY_DIGEST.match(digest):
+                yield os.path.join(subdir, file_name)
+
+    def entry_paths(self):
+        """
+        Paths of the entries this cache wrote, <sha1><entry_ext> files in the subdirectory named by the sha1's first
+        two characters. Nothing else in the directory is counted or evicted.
+        """
+        for subdir_name in self.entry_subdirs():
+            for path in self.subdir_entry_paths(subdir_name):
+                yield path
+
+    def estimate_total_bytes(self, n_sampled=8):
+        """
+        Size of the cache extrapolated from n_sampled of its subdirectories. Keys hash evenly over the
+        subdirectories, so on a cache big enough to need eviction this is close to a full scan at a fraction of it.
+        """
+        subdir_names = self.entry_subdirs()
+        if not subdir_names:
+            return 0
+        sampled = random.sample(subdir_names, min(n_sampled, len(subdir_names)))
+        sampled_bytes = 0
+        for subdir_name in sampled:
+            for path in self.subdir_entry_paths(subdir_name):
+                try:
+                    sampled_bytes += os.path.getsize(path)
+                except OSError:
+                    continue
+        return sampled_bytes * len(subdir_names) // len(sampled)
+
+    def path_for(self, key):
+        digest = bytes_digest(key)
+        return os.path.join(self.cache_dir, digest[:2], digest + self.entry_ext)
+
+    def __contains__(self, key):
+        return os.path.isfile(self.path_for(key))
+
+    def get(self, key):
+        path = self.path_for(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path, None)
+        except (IOError, OSError):
+            return None
+        return data
+
+    def put(self, key, data):
+        path = self.path_for(key)
+        entry_dir = os.path.dirname(path)
+        if not os.path.isdir(entry_dir):
+            try:
+                os.makedirs(entry_dir)
+            except OSError:
+                pass
+        fd, tmp_path = tempfile.mkstemp(dir=entry_dir, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        try:
+            replaced_bytes = os.path.getsize(path)
+        except OSError:
+            replaced_bytes = 0
+        os.rename(tmp_path, path)
+        if self.total_bytes is None or self.puts_since_estimate >= self.estimate_every:
+            self.total_bytes = self.estimate_total_bytes()
+            self.puts_since_estimate = 0
+        else:
+            self.total_bytes += len(data) - replaced_bytes
+        self.puts_since_estimate += 1
+        if self.total_bytes > self.max_bytes:
+            self.evict()
+        return path
+
+    def evict(self, target_fraction=0.9):
+        entries = []
+        for path in self.entry_paths():
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        self.total_bytes = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if self.total_bytes <= self.max_bytes * target_fraction:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            self.total_bytes -= size
+
+    def get_object(self, key):
+        data = self.get(key)
+        if data is None:
+            return None
+        return pickle.loads(zlib.decompress(data))
+
+    def put_object(self, key, obj, compress_level=1):
+        return self.put(key, zlib.compress(pickle.dumps(obj, pickle.HIGHEST_PROTOCOL), compress_level))
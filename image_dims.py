@@ -0,0 +1,134 @@
+import glob
+import io
+import json
+import os
+import struct
+import tempfile
+import threading
+from multiprocessing.pool import ThreadPool
+
+import PIL.Image as Image
+import requests
+
+
+def local_image_size(image_path):
+    """
+    PIL parses only the header on open, the pixel data is never read or decoded.
+    :return: (width, height) of an image file
+    """
+    with open(image_path, 'rb') as f:
+        return Image.open(f).size
+
+
+def probe_image_size(image_url, session=None, probe_bytes=1 << 16):
+    """
+    Reads the size of a remote image from its first probe_bytes, falling back to the whole image only when the
+    header lies further in, e.g. behind a large EXIF block.
+    :return: (width, height) of the image
+    """
+    session = session or requests
+    response = session.get(image_url, headers={'Range': 'bytes=0-{}'.format(probe_bytes - 1)}, stream=True)
+    try:
+        head = response.raw.read(probe_bytes)
+    finally:
+        response.close()
+    try:
+        return Image.open(io.BytesIO(head)).size
+    except (IOError, SyntaxError, ValueError, struct.error):
+        return Image.open(io.BytesIO(session.get(image_url).content)).size
+
+
+class ImageDimIndex(object):
+    """
+    (width, height) of the images in one directory, read from their headers and stored beside them, so each image
+    is opened once however many tools ask for its size. Entries carry the file's size and mtime and are re-read
+    when the image changes.
+    """
+
+    index_file_name = '.image_dims.json'
+
+    def __init__(self, image_dir):
+        self.image_dir = image_dir
+        self.index_path = os.path.join(image_dir, self.index_file_name)
+        self.entries = {}
+        self.lock = threading.Lock()
+        if os.path.isfile(self.index_path):
+            with open(self.index_path) as f:
+                self.entries = json.load(f)
+
+    def file_stamp(self, file_name):
+        stat = os.stat(os.path.join(self.image_dir, file_name))
+        return [stat.st_size, stat.st_mtime]
+
+    def is_current(self, file_name):
+        entry = self.entries.get(file_name)
+        return entry is not None and entry[2:] == self.file_stamp(file_name)
+
+    def read_entry(self, file_name):
+        try:
+            return file_name, list(local_image_size(os.path.join(self.image_dir, file_name))) + \
+                self.file_stamp(file_name)
+        except IOError:
+            return file_name, None
+
+    def build(self, pattern='*', n_workers=16):
+        """
+        Reads the headers of the images matching pattern that are missing or stale, n_workers at a time, and
+        saves the index. Files that are not images are skipped.
+        :return: self
+        """
+        file_names = [os.path.basename(image_path) for image_path in glob.glob(os.path.join(self.image_dir, pattern))]
+        stale = [file_name for file_name in file_names
+                 if file_name != self.index_file_name and not self.is_current(file_name)]
+        if not stale:
+            return self
+        pool = ThreadPool(n_workers)
+        try:
+            entries = pool.map(self.read_entry, stale)
+        finally:
+            pool.terminate()
+        with self.lock:
+            self.entries.update((file_name, entry) for file_name, entry in entries if entry is not None)
+            self.save()
+        return self
+
+    def size(self, image_path):
+        """
+        :param image_path: image in this index's directory
+        :return: (width, height) of the image, read and added to the index when missing or stale
+        """
+        file_name = os.path.basename(image_path)
+        with self.lock:
+            if not self.is_current(file_name):
+                _, entry = self.read_entry(file_name)
+                if entry is None:
+                    raise IOError('cannot identify image file {}'.format(image_path))
+                self.entries[file_name] = entry
+                self.save()
+            return tuple(self.entries[file_name][:2])
+
+    def save(self):
+        fd, tmp_path = tempfile.mkstemp(dir=self.image_dir, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            json.dump(self.entries, f)
+        os.rename(tmp_path, self.index_path)
+
+
+image_dim_indexes = {}
+
+
+def image_dim_index(image_dir):
+    """
+    :return: the ImageDimIndex of image_dir, shared by every caller in this process
+    """
+    image_dir = os.path.abspath(image_dir)
+    if image_dir not in image_dim_indexes:
+        image_dim_indexes[image_dir] = ImageDimIndex(image_dir)
+    return image_dim_indexes[image_dir]
+
+
+def indexed_image_size(image_path):
+    """
+    :return: (width, height) of a local image, from its directory's ImageDimIndex
+    """
+    return image_dim_index(os.path.dirname(image_path) or '.').size(image_path)
@@ -0,0 +1,96 @@
+import numpy as np
+
+from pdfminer.layout import LTChar, LTFigure, LTTextBox, LTTextLine
+
+
+class LayoutTable(object):
+    """
+    Columnar stand-in for one page's layout. Text lines are rows of parallel arrays (bbox, font size, RGB colour)
+    whose strings live in a single text buffer sliced by text_offsets; figures are rows of figure_bboxes.
+    Boxes keep the coordinate system of the source, pdfminer measures y up from the page bottom and poppler down
+    from the top. pdfminer does not record text colour, so its colour rows are NaN.
+    """
+
+    def __init__(self, page_bbox, line_bboxes, font_sizes, colors, text, text_offsets, figure_bboxes):
+        self.page_bbox = page_bbox
+        self.line_bboxes = line_bboxes
+        self.font_sizes = font_sizes
+        self.colors = colors
+        self.text = text
+        self.text_offsets = text_offsets
+        self.figure_bboxes = figure_bboxes
+
+    def __len__(self):
+        return len(self.font_sizes)
+
+    def __repr__(self):
+        return '<LayoutTable lines=%d figures=%d>' % (len(self), len(self.figure_bboxes))
+
+    @classmethod
+    def from_rows(cls, page_bbox, line_rows, figure_rows):
+        texts = [row[0] for row in line_rows]
+        text_offsets = np.zeros(len(texts) + 1, dtype=np.int32)
+        text_offsets[1:] = np.cumsum([len(text) for text in texts])
+        return cls(page_bbox,
+                   np.array([row[1] for row in line_rows], dtype=np.float64).reshape(-1, 4),
+                   np.array([row[2] for row in line_rows], dtype=np.float64),
+                   np.array([row[3] for row in line_rows], dtype=np.float64).reshape(-1, 3),
+                   u''.join(texts),
+                   text_offsets,
+                   np.array(figure_rows, dtype=np.float64).reshape(-1, 4))
+
+    @classmethod
+    def from_pdfminer(cls, layout):
+        """
+        :param layout: pdfminer LTPage
+        :return: LayoutTable of the page's text lines and top level figures
+        """
+        def line_row(line):
+            chars = [ob for ob in line if isinstance(ob, LTChar)]
+            font_size = chars[0].size if chars else np.nan
+            return line.get_text(), line.bbox, font_size, (np.nan, np.nan, np.nan)
+
+        line_rows = []
+        figure_rows = []
+        for layout_ob in layout:
+            if isinstance(layout_ob, LTTextBox):
+                line_rows.extend(line_row(line) for line in layout_ob if isinstance(line, LTTextLine))
+            elif isinstance(layout_ob, LTTextLine):
+                line_rows.append(line_row(layout_ob))
+            elif isinstance(layout_ob, LTFigure):
+                figure_rows.append(layout_ob.bbox)
+        return cls.from_rows(layout.bbox, line_rows, figure_rows)
+
+    @classmethod
+    def from_poppler(cls, page, page_bbox=None):
+        """
+        :param page: pdfparser poppler Page
+        :param page_bbox: page bbox to record, poppler text pages do not carry one
+        :return: LayoutTable of the page's text lines, poppler reports no figures
+        """
+        line_rows = []
+        for flow in page:
+            for block in flow:
+                for line in block:
+                    first_font = list(line.char_fonts)[0]
+                    line_rows.append((line.text, line.bbox.as_tuple(), first_font.size, first_font.color.as_tuple()))
+        return cls.from_rows(page_bbox, line_rows, [])
+
+    def line_text(self, line_n):
+        return self.text[self.text_offsets[line_n]:self.text_offsets[line_n + 1]]
+
+    def iter_lines(self):
+        for line_n in range(len(self)):
+            yield {
+                'content': self.line_text(line_n),
+                'rectangle': tuple(self.line_bboxes[line_n].tolist()),
+                'font_size': float(self.font_sizes[line_n]),
+                'font_color': tuple(self.colors[line_n].tolist())
+            }
+
+    def figure_bbox_list(self):
+        return [tuple(bbox) for bbox in self.figure_bboxes.tolist()]
+
+    def nbytes(self):
+        arrays = [self.line_bboxes, self.font_sizes, self.colors, self.text_offsets, self.figure_bboxes]
+        return sum(array.nbytes for array in arrays) + len(self.text.encode('utf-8'))
@@ -1,8 +1,20 @@
 import json
+import math
+import multiprocessing
+import time
 from collections import OrderedDict
 from collections import defaultdict
+from collections import namedtuple
 from copy import deepcopy
 
+import numpy as np
+
+from merge_features import PairwiseFeatures, vectorizable, same_line_matrix, adjacent_lines_matrix, contained_matrix
+
+
+# past this many boxes the n x n predicate matrices cost more than the spatial grid's pair by pair tests
+MAX_MATRIX_BOXES = 600
+
 
 class Detection:
 
@@ -183,6 +195,270 @@ def merge_adjacent_lines(this_box, other_box, merge_p):
     return (comp_all or (comp_start and not comp_line_length)) and size_comp
 
 
+def safe_character_length(box):
+    try:
+        return average_character_length(box)
+    except ZeroDivisionError:
+        return float('inf')
+
+
+def neighbour_radius(param, char_length, min_char_length):
+    """
+    Bounds param * min(char_length, other box's char length), the reach of the near predicates, over every
+    other box on the page.
+    """
+    if math.isinf(char_length) or math.isinf(min_char_length):
+        return float('inf')
+    if param >= 0:
+        return max(0.0, param * char_length)
+    return max(0.0, param * char_length, param * min_char_length)
+
+
+def same_line_margins(box, merge_p, min_char_length):
+    """
+    :return: (x, y) distances within which another box has to lie for merge_same_line to hold
+    """
+    margin_x = neighbour_radius(merge_p['near_x'], safe_character_length(box), min_char_length)
+    margin_y = 0.0 if merge_p['overlap_y'] >= 0 else float('inf')
+    return margin_x, margin_y
+
+
+def adjacent_lines_margins(box, merge_p, min_char_length):
+    """
+    :return: (x, y) distances within which another box has to lie for merge_adjacent_lines to hold
+    """
+    char_length = safe_character_length(box)
+    margin_x = max(0.0 if merge_p['overlap_x'] >= 0 else float('inf'),
+                   0.0 if merge_p['near_overlap_x'] >= 0 else
+                   neighbour_radius(merge_p['start_x'], char_length, min_char_length))
+    margin_y = max(neighbour_radius(merge_p['near_y'], char_length, min_char_length),
+                   neighbour_radius(merge_p['starting_near_near_y'], char_length, min_char_length))
+    return margin_x, margin_y
+
+
+def contained_margins(box, merge_p, min_char_length):
+    """
+    :return: (x, y) distances within which another box has to lie for merge_contained to hold
+    """
+    return 0.0, 0.0
+
+
+def unbounded_margins(box, merge_p, min_char_length):
+    """
+    :return: margins that make the grid hand back every earlier box
+    """
+    return float('inf'), float('inf')
+
+
+class BoxGrid(object):
+    """
+    Uniform grid over a page's box rectangles, so finding the boxes near one box does not mean comparing it with
+    every box on the page. Cells are the size of the page's median box.
+    """
+
+    def __init__(self, boxes):
+        self.bounds = [(min(start_x(box), end_x(box)), min(start_y(box), end_y(box)),
+                        max(start_x(box), end_x(box)), max(start_y(box), end_y(box))) for box in boxes]
+        widths = sorted(x1 - x0 for x0, _, x1, _ in self.bounds)
+        heights = sorted(y1 - y0 for _, y0, _, y1 in self.bounds)
+        self.cell_width = max(float(widths[len(widths) // 2]), 1.0) if widths else 1.0
+        self.cell_height = max(float(heights[len(heights) // 2]), 1.0) if heights else 1.0
+        self.cells = defaultdict(list)
+        for box_n, (x0, y0, x1, y1) in enumerate(self.bounds):
+            for cell in self.cell_range(x0, y0, x1, y1):
+                self.cells[cell].append(box_n)
+
+    def cell_range(self, x0, y0, x1, y1):
+        for cell_x in range(int(math.floor(x0 / self.cell_width)), int(math.floor(x1 / self.cell_width)) + 1):
+            for cell_y in range(int(math.floor(y0 / self.cell_height)), int(math.floor(y1 / self.cell_height)) + 1):
+                yield cell_x, cell_y
+
+    def neighbours(self, box_n, margin_x, margin_y):
+        """
+        :return: the numbers of the boxes before box_n whose rectangles come within (margin_x, margin_y) of
+                 box_n's, in order
+        """
+        if math.isinf(margin_x) or math.isinf(margin_y):
+            return range(box_n)
+        x0, y0, x1, y1 = self.bounds[box_n]
+        x0, y0, x1, y1 = x0 - margin_x, y0 - margin_y, x1 + margin_x, y1 + margin_y
+        n_cells = (math.floor(x1 / self.cell_width) - math.floor(x0 / self.cell_width) + 1) * \
+            (math.floor(y1 / self.cell_height) - math.floor(y0 / self.cell_height) + 1)
+        if n_cells > box_n:
+            near = range(box_n)
+        else:
+            near = sorted(set(other_n for cell in self.cell_range(x0, y0, x1, y1)
+                              for other_n in self.cells.get(cell, []) if other_n < box_n))
+        return [other_n for other_n in near if self.bounds[other_n][0] <= x1 and self.bounds[other_n][2] >= x0 and
+                self.bounds[other_n][1] <= y1 and self.bounds[other_n][3] >= y0]
+
+
+def group_first_fit(boxes, belongs, merge_p, margins):
+    """
+    Puts each box in the first group, in order of creation, holding a box it belongs with, or else in a new group.
+    Only the earlier boxes within margins(box) of it are tested, margins being a bound on how far apart two
+    boxes can be for belongs to hold, so the groups are the same as testing every earlier box.
+    :param belongs: merge predicate taking (box, earlier box, merge_p)
+    :param margins: function of (box, merge_p, page's smallest character length) returning (x, y) distances
+    :return: list of box groups
+    """
+    grid = BoxGrid(boxes)
+    char_lengths = [safe_character_length(box) for box in boxes]
+    min_char_length = min(char_lengths) if char_lengths else 0.0
+    box_groups = []
+    group_ns = []
+    for box_n, box in enumerate(boxes):
+        margin_x, margin_y = margins(box, merge_p, min_char_length)
+        group_n = None
+        for other_n in sorted(grid.neighbours(box_n, margin_x, margin_y), key=lambda n: group_ns[n]):
+            if belongs(box, boxes[other_n], merge_p):
+                group_n = group_ns[other_n]
+                break
+        if group_n is None:
+            group_n = len(box_groups)
+            box_groups.append([])
+        box_groups[group_n].append(box)
+        group_ns.append(group_n)
+    return box_groups
+
+
+def group_first_fit_matrix(boxes, adjacency):
+    """
+    group_first_fit over a precomputed predicate matrix: each box joins the earliest created group among those
+    of the earlier boxes it belongs with.
+    :param adjacency: bool matrix, adjacency[i, j] is belongs(box i, box j, merge_p)
+    :return: list of box groups
+    """
+    box_groups = []
+    group_ns = np.zeros(len(boxes), dtype=int)
+    for box_n, box in enumerate(boxes):
+        earlier_groups = group_ns[:box_n][adjacency[box_n, :box_n]]
+        if len(earlier_groups):
+            group_n = earlier_groups.min()
+        else:
+            group_n = len(box_groups)
+            box_groups.append([])
+        box_groups[group_n].append(box)
+        group_ns[box_n] = group_n
+    return box_groups
+
+
+class DisjointSet(object):
+    """
+    Union-find over the numbers 0..n-1, with path halving and union by size.
+    """
+
+    def __init__(self, n_items):
+        self.parents = list(range(n_items))
+        self.sizes = [1] * n_items
+
+    def find(self, item):
+        parents = self.parents
+        while parents[item] != item:
+            parents[item] = parents[parents[item]]
+            item = parents[item]
+        return item
+
+    def union(self, item, other_item):
+        root, other_root = self.find(item), self.find(other_item)
+        if root == other_root:
+            return
+        if self.sizes[root] < self.sizes[other_root]:
+            root, other_root = other_root, root
+        self.parents[other_root] = root
+        self.sizes[root] += self.sizes[other_root]
+
+    def components(self):
+        """
+        :return: lists of items, each in order, ordered by their first item
+        """
+        component_ns = {}
+        components = []
+        for item in range(len(self.parents)):
+            root = self.find(item)
+            if root not in component_ns:
+                component_ns[root] = len(components)
+                components.append([])
+            components[component_ns[root]].append(item)
+        return components
+
+
+def grid_edges(boxes, belongs, merge_p, margins):
+    """
+    :return: generator of (box_n, earlier box_n) pairs for which belongs holds, tested through the spatial grid
+    """
+    grid = BoxGrid(boxes)
+    char_lengths = [safe_character_length(box) for box in boxes]
+    min_char_length = min(char_lengths) if char_lengths else 0.0
+    for box_n, box in enumerate(boxes):
+        margin_x, margin_y = margins(box, merge_p, min_char_length)
+        for other_n in grid.neighbours(box_n, margin_x, margin_y):
+            if belongs(box, boxes[other_n], merge_p):
+                yield box_n, other_n
+
+
+def matrix_edges(adjacency):
+    """
+    :return: (box_n, earlier box_n) pairs set in a predicate matrix
+    """
+    box_ns, other_ns = np.nonzero(np.tril(adjacency, -1))
+    return zip(box_ns.tolist(), other_ns.tolist())
+
+
+def group_connected(boxes, edges):
+    """
+    Groups boxes into the connected components of the edges, so two groups that a box belongs with both end up
+    in one group. Unlike first-fit the groups do not depend on the order boxes are visited in.
+    :param edges: iterable of (box_n, other box_n) pairs
+    :return: list of box groups, ordered by their first box, each in box order
+    """
+    disjoint_set = DisjointSet(len(boxes))
+    for box_n, other_n in edges:
+        disjoint_set.union(box_n, other_n)
+    return [[boxes[box_n] for box_n in component] for component in disjoint_set.components()]
+
+
+GROUPINGS = ('first_fit', 'connected')
+
+
+def pass_grouping(grouping, pass_name):
+    """
+    :param grouping: one of GROUPINGS for every pass, None for first_fit, or a dict of pass name ('horizontal',
+                     'vertical' or 'final') to grouping, passes left out using first_fit
+    :return: the grouping of the named pass
+    """
+    if isinstance(grouping, dict):
+        grouping = grouping.get(pass_name)
+    grouping = grouping or 'first_fit'
+    if grouping not in GROUPINGS:
+        raise ValueError('unknown grouping {}, expected one of {}'.format(grouping, GROUPINGS))
+    return grouping
+
+
+def group_boxes(boxes, belongs, merge_p, margins, belongs_matrix, grouping='first_fit'):
+    """
+    Groups a pass's boxes, from the pairwise predicate matrix when the page allows it and otherwise pair by pair
+    through the spatial grid. On pages where a predicate can divide by zero the grid's margins do not bound
+    anything, so every earlier box is tested, in the order the per pair merge always tested them, and the pass
+    raises exactly where it did.
+    :param belongs_matrix: function of (PairwiseFeatures, merge_p) returning the bool matrix of belongs
+    :param grouping: 'first_fit', each box joins the first group holding a box it belongs with, or 'connected',
+                     the connected components of belongs
+    """
+    boxes = list(boxes)
+    adjacency = None
+    if not vectorizable(boxes):
+        margins = unbounded_margins
+    elif len(boxes) <= MAX_MATRIX_BOXES:
+        adjacency = belongs_matrix(PairwiseFeatures.from_boxes(boxes), merge_p)
+    if grouping == 'connected':
+        edges = matrix_edges(adjacency) if adjacency is not None else grid_edges(boxes, belongs, merge_p, margins)
+        return group_connected(boxes, edges)
+    if adjacency is not None:
+        return group_first_fit_matrix(boxes, adjacency)
+    return group_first_fit(boxes, belongs, merge_p, margins)
+
+
 def make_annotation_json(box, book_name, page_n, category):
     def point_to_tuple(box):
         return tuple(OrderedDict(sorted(box.items())).values())
@@ -234,9 +510,17 @@ def check_for_ocr_dupes(detections):
     pass
 
 
-def merge_boxes(detections, merge_params, book_name, page_n, merge_pass):
+def ordered_detections(detections):
+    """
+    :param detections: a page's text boxes keyed by box id
+    :return: OrderedDict of the boxes by box number, the order the merge passes visit them in
+    """
     int_keys = {int(k[1:]): v for k, v in sorted(detections.items(), key=lambda x: x[1]['rectangle'][0][1])}
-    sorted_detections = OrderedDict(sorted(int_keys.items()))
+    return OrderedDict(sorted(int_keys.items()))
+
+
+def merge_boxes(detections, merge_params, book_name, page_n, merge_pass, grouping=None):
+    sorted_detections = ordered_detections(detections)
 
     def merge_categories(g):
         possible_cats = [box['category'] for box in g]
@@ -262,18 +546,8 @@ def merge_boxes(detections, merge_params, book_name, page_n, merge_pass):
         return new_detection
 
     def merge_horizontal_pass(detected_boxes, merge_p):
-        rectangle_groups = []
-        for name, current_d in detected_boxes.items():
-            found_group = False
-            for g in rectangle_groups:
-                if not found_group:
-                    for d in g:
-                        if merge_same_line(current_d, d, merge_p):
-                            g.append(current_d)
-                            found_group = True
-                            break
-            if not found_group:
-                rectangle_groups.append([current_d])
+        rectangle_groups = group_boxes(detected_boxes.values(), merge_same_line, merge_p, same_line_margins,
+                                       same_line_matrix, pass_grouping(grouping, 'horizontal'))
 
         new_detections = []
         for g in rectangle_groups:
@@ -285,18 +559,8 @@ def merge_boxes(detections, merge_params, book_name, page_n, merge_pass):
         return sorted(new_detections, key=lambda x: x['rectangle'][0][1])
 
     def merge_vertical_pass(detected_boxes, merge_p):
-        rectangle_groups = []
-        for current_d in detected_boxes:
-            found_group = False
-            for g in rectangle_groups:
-                if not found_group:
-                    for d in g:
-                        if merge_adjacent_lines(current_d, d, merge_p):
-                            g.append(current_d)
-                            found_group = True
-                            break
-            if not found_group:
-                rectangle_groups.append([current_d])
+        rectangle_groups = group_boxes(detected_boxes, merge_adjacent_lines, merge_p, adjacent_lines_margins,
+                                       adjacent_lines_matrix, pass_grouping(grouping, 'vertical'))
 
         new_detections = []
         for g in rectangle_groups:
@@ -311,18 +575,8 @@ def merge_boxes(detections, merge_params, book_name, page_n, merge_pass):
         return new_detections
 
     def merge_final_pass(detected_boxes, merge_p):
-        rectangle_groups = []
-        for current_d in detected_boxes:
-            found_group = False
-            for g in rectangle_groups:
-                if not found_group:
-                    for d in g:
-                        if merge_contained(current_d, d, merge_p):
-                            g.append(current_d)
-                            found_group = True
-                            break
-            if not found_group:
-                rectangle_groups.append([current_d])
+        rectangle_groups = group_boxes(detected_boxes, merge_contained, merge_p, contained_margins, contained_matrix,
+                                       pass_grouping(grouping, 'final'))
 
         new_detections = []
         for g in rectangle_groups:
@@ -344,14 +598,125 @@ def merge_boxes(detections, merge_params, book_name, page_n, merge_pass):
         return None
 
 
-def merge_single_page(file_path, merge_params, book_name, page_n, merge_pass):
+def merge_single_page(file_path, merge_params, book_name, page_n, merge_pass, grouping=None):
     with open(file_path, 'r') as f:
         annotations = json.load(f)
-    merged_annotation = merge_boxes(annotations['text'], merge_params, book_name, page_n, merge_pass)
+    merged_annotation = merge_boxes(annotations['text'], merge_params, book_name, page_n, merge_pass, grouping)
     return merged_annotation
 
 
-def merge_single_book(book_name, (start_n, stop_n), destination_path, base_path, merge_params, merge_pass=1):
+def write_merged_page(file_path, new_file_path, merge_params, book_name, page_n, merge_pass, grouping=None):
+    """
+    Merges one page's annotation file and writes the merged annotation.
+    :return: number of merged text boxes
+    """
+    merged_text_anno = merge_single_page(file_path, merge_params, book_name, page_n, merge_pass, grouping)
+    merged_text_named = {'T'+str(i + 1): merged_text_anno[i] for i in range(len(merged_text_anno))}
+
+    for name, detection in merged_text_named.items():
+        detection['box_id'] = name
+
+    full_anno = {"text": merged_text_named, "figure": {}, "relationship": {}}
+
+    with open(new_file_path, 'w') as f:
+        json.dump(full_anno, f, indent=4, sort_keys=True)
+    return len(merged_text_named)
+
+
+MergeResult = namedtuple('MergeResult', ['book_name', 'page_n', 'n_boxes', 'error', 'seconds'])
+
+
+def merge_page_job(page_job):
+    """
+    :param page_job: (book_name, page_n, file_path, new_file_path, merge_params, merge_pass, grouping) tuple
+    :return: MergeResult, error holds the exception's type and message when the page failed
+    """
+    book_name, page_n, file_path, new_file_path, merge_params, merge_pass, grouping = page_job
+    start_time = time.time()
+    try:
+        n_boxes = write_merged_page(file_path, new_file_path, merge_params, book_name, page_n, merge_pass, grouping)
+    except Exception as e:
+        return MergeResult(book_name, page_n, None, '{}: {}'.format(type(e).__name__, e), time.time() - start_time)
+    return MergeResult(book_name, page_n, n_boxes, None, time.time() - start_time)
+
+
+def book_page_jobs(book_name, (start_n, stop_n), destination_path, base_path, merge_params, merge_pass=1,
+                   grouping=None):
+    book_stem = book_name.replace('.pdf', '')
+    for page_n in range(start_n, stop_n):
+        file_path = base_path + book_stem + '_' + str(page_n) + '.json'
+        new_file_path = destination_path + book_stem + '_' + str(page_n) + '.json'
+        yield book_name, page_n, file_path, new_file_path, merge_params, merge_pass, grouping
+
+
+def iter_merge_books(books, destination_path, base_path, merge_params, merge_pass=1, grouping=None, n_workers=1,
+                     chunksize=4):
+    """
+    Merges every page of several books, page by page across a process pool.
+    :param books: iterable of (book_name, (start_n, stop_n)) tuples, stop_n exclusive
+    :param n_workers: worker processes, 1 merges in this process
+    :param chunksize: pages handed to a worker at a time
+    :return: generator of MergeResults in book and page order
+    """
+    page_jobs = (page_job for book_name, page_range in books
+                 for page_job in book_page_jobs(book_name, page_range, destination_path, base_path, merge_params,
+                                                merge_pass, grouping))
+    if n_workers <= 1:
+        for page_job in page_jobs:
+            yield merge_page_job(page_job)
+        return
+
+    pool = multiprocessing.Pool(n_workers)
+    try:
+        for result in pool.imap(merge_page_job, page_jobs, chunksize):
+            yield result
+    except BaseException:
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+
+
+def summarize_merge_results(results, wall_seconds):
+    """
+    :param results: MergeResults of one run
+    :param wall_seconds: wall clock time of the run
+    :return: dict of page counts, throughput and the (book_name, page_n, error) of every failed page
+    """
+    failures = [(result.book_name, result.page_n, result.error) for result in results if result.error is not None]
+    return {
+        'pages': len(results),
+        'pages_per_second': len(results) / wall_seconds if wall_seconds else float('inf'),
+        'merged_pages': len(results) - len(failures),
+        'failed_pages': failures
+    }
+
+
+def merge_books(books, destination_path, base_path, merge_params, merge_pass=1, grouping=None, n_workers=1):
+    """
+    Merges the text boxes of several books, see merge_single_book, printing each failed page as it comes in and
+    a summary at the end.
+    :param books: iterable of (book_name, (start_n, stop_n)) tuples, stop_n exclusive
+    :param n_workers: worker processes
+    :return: dict from summarize_merge_results
+    """
+    start_time = time.time()
+    results = []
+    for result in iter_merge_books(books, destination_path, base_path, merge_params, merge_pass, grouping,
+                                   n_workers):
+        if result.error is not None:
+            print('%s page %d failed: %s' % (result.book_name, result.page_n, result.error))
+        results.append(result)
+    summary = summarize_merge_results(results, time.time() - start_time)
+    print('merged %d of %d pages, %.1f pages/s, %d failed' % (
+        summary['merged_pages'], summary['pages'], summary['pages_per_second'], len(summary['failed_pages'])))
+    return summary
+
+
+def merge_single_book(book_name, (start_n, stop_n), destination_path, base_path, merge_params, merge_pass=1,
+                      grouping=None, n_workers=1):
     """
     Merges the text boxes for a single book based on criteria specified by in merge_params and writes them to disk.
     :param book_name: textbook to process
@@ -360,23 +725,9 @@ def merge_single_book(book_name, (start_n, stop_n), destination_path, base_path,
     :param base_path: base turk data path
     :param merge_params: parameters used when assessing two boxes to potentially merge
     :param merge_pass: specifies whether this is a first merging or second (remerging) of the text
-    :return: None
+    :param grouping: how each pass groups boxes, see pass_grouping, first-fit by default
+    :param n_workers: worker processes to merge pages on
+    :return: dict from summarize_merge_results
     """
-    for page_n in range(start_n, stop_n):
-        try:
-            file_path = base_path + book_name.replace('.pdf', '') + '_' + str(page_n) + '.json'
-            merged_text_anno = merge_single_page(file_path, merge_params, book_name, page_n, merge_pass)
-            merged_text_named = {'T'+str(i + 1): merged_text_anno[i] for i in range(len(merged_text_anno))}
-
-            for name, detection in merged_text_named.items():
-                detection['box_id'] = name
-
-            new_file_path = destination_path + book_name.replace('.pdf', '') + '_' + str(page_n) + '.json'
-            full_anno = {"text": merged_text_named, "figure": {}, "relationship": {}}
-
-            with open(new_file_path, 'w') as f:
-                json.dump(full_anno, f, indent=4, sort_keys=True)
-        except IOError as e:
-            print e
-    return
-
+    return merge_books([(book_name, (start_n, stop_n))], destination_path, base_path, merge_params, merge_pass,
+                       grouping, n_workers)
@@ -0,0 +1,147 @@
+import numpy as np
+
+
+def box_rectangles(boxes):
+    """
+    :return: float64 array of shape (n, 4) of each box's (start_x, start_y, end_x, end_y)
+    """
+    return np.array([[box['rectangle'][0][0], box['rectangle'][0][1], box['rectangle'][1][0], box['rectangle'][1][1]]
+                     for box in boxes], dtype=np.float64).reshape(-1, 4)
+
+
+def vectorizable(boxes):
+    """
+    The matrices are exact stand-ins for the per pair merge predicates when no predicate divides by zero, i.e.
+    every box has text and a positive width and height. Pages that break this are merged by testing every pair,
+    see merge.group_boxes.
+    """
+    rectangles = box_rectangles(boxes)
+    return all(len(box['contents']) for box in boxes) and \
+        bool((rectangles[:, 2] > rectangles[:, 0]).all() and (rectangles[:, 3] > rectangles[:, 1]).all())
+
+
+def lazy_matrix(compute):
+    """
+    Property computed on first access and kept in the instance's matrices dict, so a pass only pays for the
+    matrices its predicate reads.
+    """
+    name = compute.__name__
+
+    def get(self):
+        if name not in self.matrices:
+            self.matrices[name] = compute(self)
+        return self.matrices[name]
+    return property(get, doc=compute.__doc__)
+
+
+class PairwiseFeatures(object):
+    """
+    Parameter free geometry of every pair of a page's boxes, as n x n matrices whose row i relates box i to every
+    box j the way the merge predicates see (this_box, other_box). Each matrix is computed once per page, on first
+    use, after which any merge_params setting is a few array comparisons away. Values are computed with the same
+    float operations as the per pair predicates, so comparisons against them come out the same.
+    """
+
+    def __init__(self, rectangles, n_chars):
+        """
+        :param rectangles: array of shape (n, 4) of each box's (start_x, start_y, end_x, end_y)
+        :param n_chars: array of the length of each box's contents
+        """
+        self.start_x, self.start_y, self.end_x, self.end_y = np.asarray(rectangles, dtype=np.float64).reshape(-1, 4).T
+        n_chars = np.asarray(n_chars, dtype=np.float64)
+        self.widths = self.end_x - self.start_x
+        self.heights = self.end_y - self.start_y
+        self.char_lengths = self.widths / n_chars
+        self.matrices = {}
+
+    @classmethod
+    def from_boxes(cls, boxes):
+        return cls(box_rectangles(boxes), [len(box['contents']) for box in boxes])
+
+    def __len__(self):
+        return len(self.widths)
+
+    def nbytes(self):
+        arrays = [self.start_x, self.start_y, self.end_x, self.end_y, self.widths, self.heights, self.char_lengths]
+        return sum(array.nbytes for array in arrays + self.matrices.values())
+
+    @lazy_matrix
+    def min_char_lengths(self):
+        return np.minimum(self.char_lengths[:, None], self.char_lengths[None, :])
+
+    @lazy_matrix
+    def char_size_ratios(self):
+        max_char_lengths = np.maximum(self.char_lengths[:, None], self.char_lengths[None, :])
+        return (max_char_lengths - self.min_char_lengths) / self.min_char_lengths
+
+    @lazy_matrix
+    def x_intersections(self):
+        return np.minimum(self.end_x[:, None], self.end_x[None, :]) - \
+            np.maximum(self.start_x[:, None], self.start_x[None, :])
+
+    @lazy_matrix
+    def y_intersections(self):
+        return np.minimum(self.end_y[:, None], self.end_y[None, :]) - \
+            np.maximum(self.start_y[:, None], self.start_y[None, :])
+
+    @lazy_matrix
+    def x_overlaps(self):
+        return np.maximum(self.x_intersections, 0) / np.maximum(self.widths[:, None], self.widths[None, :])
+
+    @lazy_matrix
+    def y_overlaps(self):
+        return np.maximum(self.y_intersections, 0) / np.maximum(self.heights[:, None], self.heights[None, :])
+
+    @lazy_matrix
+    def x_distances(self):
+        return np.minimum(np.abs(self.start_x[None, :] - self.end_x[:, None]),
+                          np.abs(self.start_x[:, None] - self.end_x[None, :]))
+
+    @lazy_matrix
+    def y_distances(self):
+        return np.minimum(np.abs(self.start_y[None, :] - self.end_y[:, None]),
+                          np.abs(self.start_y[:, None] - self.end_y[None, :]))
+
+    @lazy_matrix
+    def start_distances(self):
+        return np.abs(self.start_x[:, None] - self.start_x[None, :])
+
+    @lazy_matrix
+    def touching(self):
+        return (self.x_intersections >= 0) & (self.y_intersections >= 0)
+
+    @lazy_matrix
+    def contained_fractions(self):
+        areas = self.heights * self.widths
+        return np.where(self.touching, self.x_intersections * self.y_intersections, 0) / \
+            np.minimum(areas[:, None], areas[None, :])
+
+
+def same_line_matrix(features, merge_p):
+    """
+    :return: bool matrix of merge_same_line(box i, box j, merge_p)
+    """
+    return (features.x_distances < features.min_char_lengths * merge_p['near_x']) & \
+        (features.y_overlaps > merge_p['overlap_y']) & \
+        (features.char_size_ratios < merge_p['char_size_ratio'])
+
+
+def adjacent_lines_matrix(features, merge_p):
+    """
+    :return: bool matrix of merge_adjacent_lines(box i, box j, merge_p)
+    """
+    comp_all = (features.y_distances < features.min_char_lengths * merge_p['near_y']) & \
+        (features.x_overlaps > merge_p['overlap_x'])
+    comp_start = (features.y_distances < features.min_char_lengths * merge_p['starting_near_near_y']) & \
+        (features.start_distances < features.min_char_lengths * merge_p['start_x']) & \
+        (features.x_overlaps > merge_p['near_overlap_x'])
+    short_lines = features.widths < features.char_lengths * merge_p['short_length']
+    return (comp_all | (comp_start & ~short_lines[:, None])) & \
+        (features.char_size_ratios < merge_p['char_size_ratio'])
+
+
+def contained_matrix(features, merge_p):
+    """
+    :return: bool matrix of merge_contained(box i, box j, merge_p)
+    """
+    return features.touching & (features.contained_fractions > merge_p['overlap_fract'])
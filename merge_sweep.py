@@ -0,0 +1,233 @@
+import json
+import time
+from copy import deepcopy
+from itertools import chain, product
+
+import numpy as np
+
+from merge import ordered_detections, merge_boxes, pass_grouping, group_first_fit_matrix, group_connected, \
+    matrix_edges
+from merge_features import PairwiseFeatures, box_rectangles, vectorizable, same_line_matrix, \
+    adjacent_lines_matrix, contained_matrix
+
+
+# predicate matrix of each merge pass, the merge_params it reads and whether its output is re-sorted by start_y
+SWEEP_PASSES = {
+    'horizontal': (same_line_matrix, ('near_x', 'overlap_y', 'char_size_ratio'), True),
+    'final': (contained_matrix, ('overlap_fract',), True),
+    'vertical': (adjacent_lines_matrix, ('near_y', 'overlap_x', 'starting_near_near_y', 'start_x', 'near_overlap_x',
+                                         'short_length', 'char_size_ratio'), False)
+}
+
+
+def expand_param_grid(base_params, param_grid):
+    """
+    :param base_params: merge_params every setting starts from
+    :param param_grid: dict of merge_params name to the values to try
+    :return: list of merge_params, one per combination of the grid's values
+    """
+    names = sorted(param_grid)
+    settings = []
+    for values in product(*[param_grid[name] for name in names]):
+        merge_p = dict(base_params)
+        merge_p.update(zip(names, values))
+        settings.append(merge_p)
+    return settings
+
+
+class PageSweep(object):
+    """
+    One page's text boxes set up to be merged under many merge_params settings. A box is tracked as the tuple of
+    the page's original boxes it was merged from, its rectangle being their bounding box and its contents their
+    words joined by spaces, so the passes only need predicate matrices over PairwiseFeatures computed once per
+    distinct list of boxes. Settings that agree on the parameters a pass reads share its result. The boxes come
+    out exactly as merge_boxes merges them. Pages merge_boxes cannot vectorize are merged by it, setting by
+    setting.
+    """
+
+    def __init__(self, detections):
+        self.detections = detections
+        self.boxes = ordered_detections(detections).values()
+        self.rectangles = box_rectangles(self.boxes)
+        self.n_chars = np.array([len(box['contents']) for box in self.boxes], dtype=np.int64)
+        self.exact = vectorizable(self.boxes)
+        self.geometry = {}
+        self.features = {}
+        self.pass_results = {}
+
+    def unit_geometry(self, units):
+        """
+        :return: (rectangles, n_chars) arrays of boxes made of the given tuples of original boxes
+        """
+        if units not in self.geometry:
+            if not units:
+                return np.zeros((0, 4)), np.zeros(0, dtype=np.int64)
+            unit_lengths = np.array([len(unit) for unit in units])
+            offsets = np.concatenate([[0], np.cumsum(unit_lengths)[:-1]])
+            member_ns = list(chain.from_iterable(units))
+            members = self.rectangles[member_ns]
+            rectangles = np.column_stack([np.minimum.reduceat(members[:, 0], offsets),
+                                          np.minimum.reduceat(members[:, 1], offsets),
+                                          np.maximum.reduceat(members[:, 2], offsets),
+                                          np.maximum.reduceat(members[:, 3], offsets)])
+            # merged contents are the members' words joined by single spaces
+            n_chars = np.add.reduceat(self.n_chars[member_ns], offsets) + unit_lengths - 1
+            self.geometry[units] = rectangles, n_chars
+        return self.geometry[units]
+
+    def unit_features(self, units):
+        if units not in self.features:
+            self.features[units] = PairwiseFeatures(*self.unit_geometry(units))
+        return self.features[units]
+
+    def run_pass(self, pass_name, units, merge_p, grouping):
+        belongs_matrix, param_names, sort_by_y = SWEEP_PASSES[pass_name]
+        pass_key = (pass_name, units, tuple(merge_p[name] for name in param_names), grouping)
+        if pass_key not in self.pass_results:
+            adjacency = belongs_matrix(self.unit_features(units), merge_p)
+            unit_ns = range(len(units))
+            if grouping == 'connected':
+                groups = group_connected(unit_ns, matrix_edges(adjacency))
+            else:
+                groups = group_first_fit_matrix(unit_ns, adjacency)
+            merged = tuple(tuple(sorted(chain.from_iterable(units[unit_n] for unit_n in group))) for group in groups)
+            if sort_by_y:
+                start_ys = self.unit_geometry(merged)[0][:, 1]
+                merged = tuple(merged[unit_n] for unit_n in np.argsort(start_ys, kind='mergesort'))
+            self.pass_results[pass_key] = merged
+        return self.pass_results[pass_key]
+
+    def merge_units(self, merge_params, merge_pass=1, grouping=None):
+        """
+        :return: tuple of merged boxes, each a tuple of original box numbers, in merge_boxes' output order
+        """
+        units = tuple((box_n,) for box_n in range(len(self.boxes)))
+        units = self.run_pass('horizontal', units, merge_params, pass_grouping(grouping, 'horizontal'))
+        units = self.run_pass('final', units, merge_params, pass_grouping(grouping, 'final'))
+        if merge_pass == 2:
+            return units
+        elif merge_pass == 1:
+            return self.run_pass('vertical', units, merge_params, pass_grouping(grouping, 'vertical'))
+        else:
+            return None
+
+    def merged_rectangles(self, merge_params, merge_pass=1, grouping=None):
+        """
+        :return: array of shape (n, 4) of the merged boxes' (start_x, start_y, end_x, end_y)
+        """
+        if self.exact:
+            return self.unit_geometry(self.merge_units(merge_params, merge_pass, grouping))[0]
+        return box_rectangles(merge_boxes(deepcopy(self.detections), merge_params, None, None, merge_pass, grouping))
+
+
+def box_ious(rectangles, other_rectangles):
+    """
+    :return: array of shape (n, m) of the intersection over union of every pair of rectangles
+    """
+    dx = np.minimum(rectangles[:, None, 2], other_rectangles[None, :, 2]) - \
+        np.maximum(rectangles[:, None, 0], other_rectangles[None, :, 0])
+    dy = np.minimum(rectangles[:, None, 3], other_rectangles[None, :, 3]) - \
+        np.maximum(rectangles[:, None, 1], other_rectangles[None, :, 1])
+    intersections = np.maximum(dx, 0) * np.maximum(dy, 0)
+    areas = (rectangles[:, 2] - rectangles[:, 0]) * (rectangles[:, 3] - rectangles[:, 1])
+    other_areas = (other_rectangles[:, 2] - other_rectangles[:, 0]) * (other_rectangles[:, 3] - other_rectangles[:, 1])
+    unions = areas[:, None] + other_areas[None, :] - intersections
+    return intersections / np.maximum(unions, 1e-9)
+
+
+def count_matched_boxes(rectangles, labeled_rectangles, min_iou=0.5):
+    """
+    Matches merged boxes to hand-labeled ones one to one, best overlaps first.
+    :return: number of merged boxes matching a labeled box with at least min_iou intersection over union
+    """
+    if not len(rectangles) or not len(labeled_rectangles):
+        return 0
+    ious = box_ious(rectangles, labeled_rectangles)
+    box_ns, label_ns = np.nonzero(ious >= min_iou)
+    matched_boxes = set()
+    matched_labels = set()
+    for pair_n in np.argsort(-ious[box_ns, label_ns], kind='mergesort'):
+        box_n, label_n = box_ns[pair_n], label_ns[pair_n]
+        if box_n not in matched_boxes and label_n not in matched_labels:
+            matched_boxes.add(box_n)
+            matched_labels.add(label_n)
+    return len(matched_boxes)
+
+
+def sweep_merge_params(pages, settings, merge_pass=1, grouping=None, labels=None, min_iou=0.5):
+    """
+    Merges every page under every merge_params setting, page by page so each page's geometry is computed once.
+    :param pages: iterable of (page_key, text boxes) tuples, text boxes as in an annotation file's 'text'
+    :param settings: list of merge_params, e.g. from expand_param_grid
+    :param labels: optional dict of page_key to hand-labeled merged text boxes to score each setting against
+    :param min_iou: overlap a merged box needs with a labeled box to count as matching it
+    :return: list of one dict per setting with the merge_params, merged box and failed page counts and, with
+             labels, the precision, recall and f1 of the merged boxes on the labeled pages
+    """
+    totals = [{'boxes': 0, 'failed_pages': 0, 'matched': 0, 'predicted': 0, 'labeled': 0} for _ in settings]
+    n_pages = 0
+    for page_key, detections in pages:
+        n_pages += 1
+        page_sweep = PageSweep(detections)
+        labeled_detections = labels.get(page_key) if labels else None
+        labeled_rectangles = box_rectangles(labeled_detections.values()) if labeled_detections is not None else None
+        for merge_p, total in zip(settings, totals):
+            try:
+                rectangles = page_sweep.merged_rectangles(merge_p, merge_pass, grouping)
+            except (ZeroDivisionError, KeyError, ValueError):
+                total['failed_pages'] += 1
+                continue
+            total['boxes'] += len(rectangles)
+            if labeled_rectangles is not None:
+                total['matched'] += count_matched_boxes(rectangles, labeled_rectangles, min_iou)
+                total['predicted'] += len(rectangles)
+                total['labeled'] += len(labeled_rectangles)
+
+    results = []
+    for merge_p, total in zip(settings, totals):
+        result = {'merge_params': merge_p, 'pages': n_pages, 'boxes': total['boxes'],
+                  'failed_pages': total['failed_pages']}
+        if labels:
+            precision = total['matched'] / float(total['predicted']) if total['predicted'] else 0.0
+            recall = total['matched'] / float(total['labeled']) if total['labeled'] else 0.0
+            result['precision'] = precision
+            result['recall'] = recall
+            result['f1'] = 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+        results.append(result)
+    return results
+
+
+def iter_book_pages(book_name, (start_n, stop_n), base_path):
+    """
+    :return: generator of (page_n, text boxes) tuples of the book's annotation files in base_path, skipping
+             missing pages
+    """
+    book_stem = book_name.replace('.pdf', '')
+    for page_n in range(start_n, stop_n):
+        try:
+            with open(base_path + book_stem + '_' + str(page_n) + '.json', 'r') as f:
+                yield page_n, json.load(f)['text']
+        except IOError:
+            continue
+
+
+def sweep_book(book_name, page_range, base_path, base_params, param_grid, merge_pass=1, grouping=None,
+               label_path=None, min_iou=0.5):
+    """
+    Sweeps merge_params over a book's pages, see sweep_merge_params.
+    :param page_range: (start_n, stop_n) tuple, stop_n exclusive
+    :param base_params: merge_params every setting starts from
+    :param param_grid: dict of merge_params name to the values to try
+    :param label_path: optional directory of hand-labeled merged annotation files, named like the book's pages
+    :return: list of one result dict per setting, best f1 first when scored against labels
+    """
+    start_time = time.time()
+    settings = expand_param_grid(base_params, param_grid)
+    labels = dict(iter_book_pages(book_name, page_range, label_path)) if label_path else None
+    results = sweep_merge_params(iter_book_pages(book_name, page_range, base_path), settings, merge_pass, grouping,
+                                 labels, min_iou)
+    if labels:
+        results.sort(key=lambda result: -result['f1'])
+    print('swept %d settings over %d pages of %s in %.1fs' % (
+        len(settings), results[0]['pages'] if results else 0, book_name, time.time() - start_time))
+    return results
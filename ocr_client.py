@@ -0,0 +1,259 @@
+import base64
+import io
+import json
+import threading
+import time
+import zlib
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
+
+import PIL.Image as Image
+import requests
+from requests.adapters import HTTPAdapter
+
+from disk_cache import DiskCache, file_digest, bytes_digest
+
+
+OCR_ENTRY_POINT = 'http://vision-ocr.dev.allenai.org/v1/ocr'
+
+# seconds runs from the cache lookup to the result, retry backoff and waits for the limiter included, latency is
+# just the round trip of the request that got the response, None when no request did
+OCRResult = namedtuple('OCRResult', ['page_n', 'response', 'error', 'attempts', 'seconds', 'latency'])
+
+
+class OCRServiceError(Exception):
+    pass
+
+
+def make_request_data(image_url=None, merge_boxes=False, include_merged_components=False, image_path=None,
+                      image_crop=None):
+    """
+    :param image_url: url the service should fetch the page image from
+    :param image_path: local page image to upload instead, read only when the request is sent
+    :param image_crop: (left, top, right, bottom) pixel box of image_path to upload instead of the whole image
+    :return: request data for OCRClient
+    """
+    request_data = {
+        # 'maximumSizePixels': max_pix_size,
+        'mergeBoxes': merge_boxes,
+        'includeMergedComponents': include_merged_components
+    }
+    if image_path:
+        request_data['imagePath'] = image_path
+        if image_crop:
+            request_data['imageCrop'] = list(image_crop)
+    else:
+        request_data['url'] = image_url
+    return request_data
+
+
+def encode_request_data(request_data):
+    """
+    Swaps a local imagePath for the base64 encoded image itself, or just its imageCrop, so the service never has to
+    download it.
+    """
+    if 'imagePath' not in request_data:
+        return request_data
+    request_data = dict(request_data)
+    image_path = request_data.pop('imagePath')
+    image_crop = request_data.pop('imageCrop', None)
+    if image_crop:
+        page_image = Image.open(image_path)
+        image_format = page_image.format or 'PNG'
+        image_buffer = io.BytesIO()
+        page_image.crop(tuple(image_crop)).save(image_buffer, format=image_format, quality=95)
+        request_data['image'] = base64.b64encode(image_buffer.getvalue())
+    else:
+        with open(image_path, 'rb') as f:
+            request_data['image'] = base64.b64encode(f.read())
+    return request_data
+
+
+class OCRCache(object):
+    """
+    Raw OCR responses keyed by the page image's content hash and every request option, so annotations can be
+    regenerated and merge options revisited without calling the service again. Requests that only carry a url
+    are not cached unless cache_urls is set, their key is the url and the image behind it may have been
+    regenerated, e.g. at another scale, since the response was stored.
+    """
+
+    def __init__(self, cache_dir='ocr_response_cache', max_bytes=2 * 1024 ** 3, cache_urls=False):
+        self.store = DiskCache(cache_dir, max_bytes, '.ocr')
+        self.cache_urls = cache_urls
+
+    def request_key(self, request_data):
+        """
+        :return: cache key of the request, None for url requests when urls are not cached
+        """
+        if 'imagePath' in request_data:
+            image_key = file_digest(request_data['imagePath'])
+        elif 'image' in request_data:
+            image_key = bytes_digest(request_data['image'])
+        elif self.cache_urls:
+            image_key = 'url:' + request_data['url']
+        else:
+            return None
+        options = sorted((k, v) for k, v in request_data.items() if k not in ('url', 'imagePath', 'image'))
+        return '/'.join([image_key, repr(options)])
+
+    def get(self, request_data):
+        try:
+            key = self.request_key(request_data)
+        except (IOError, OSError):
+            # unreadable page images are left for the request itself to fail on
+            return None
+        response = self.store.get(key) if key is not None else None
+        return json.loads(zlib.decompress(response)) if response is not None else None
+
+    def put(self, request_data, response):
+        try:
+            key = self.request_key(request_data)
+        except (IOError, OSError):
+            return
+        if key is not None:
+            self.store.put(key, zlib.compress(json.dumps(response), 6))
+
+
+class AdaptiveLimiter(object):
+    """
+    Additive increase, multiplicative decrease limit on requests in flight. The limit grows by about one request
+    per round trip while latency stays within latency_tolerance of the baseline round trip, holds while latency
+    is above it, and is cut by backoff_factor on a timeout, 5xx or non-JSON answer. Cuts happen at most once per
+    round trip, so a burst of failures from one overload counts once. The baseline follows the fastest round
+    trips, drifting slowly up towards typical ones so jitter alone does not stall growth.
+    """
+
+    def __init__(self, initial_limit=4, min_limit=1, max_limit=64, backoff_factor=0.5, latency_tolerance=2.0,
+                 baseline_drift=0.01):
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff_factor = backoff_factor
+        self.latency_tolerance = latency_tolerance
+        self.baseline_drift = baseline_drift
+        self.in_flight = 0
+        self.base_latency = None
+        self.last_backoff = 0.0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+
+    def release(self, latency=None):
+        """
+        :param latency: round trip of a successful request, None when the request failed
+        """
+        with self.condition:
+            self.in_flight -= 1
+            if latency is None:
+                now = time.time()
+                if now - self.last_backoff > (self.base_latency or 0.0):
+                    self.limit = max(self.min_limit, self.limit * self.backoff_factor)
+                    self.last_backoff = now
+            else:
+                if self.base_latency is None or latency < self.base_latency:
+                    self.base_latency = latency
+                else:
+                    self.base_latency += (latency - self.base_latency) * self.baseline_drift
+                if latency <= self.base_latency * self.latency_tolerance:
+                    self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+            self.condition.notify_all()
+
+
+class OCRClient(object):
+    """
+    Thread safe client for the vision-ocr service. Connections are pooled and reused across requests, and each page
+    is retried with exponential backoff when the service errors, times out or answers with something other than JSON.
+    With an OCRCache, pages seen before are answered from the cache and report zero attempts. With an
+    AdaptiveLimiter, max_in_flight only caps the limiter, which settles on the rate the service can sustain.
+    """
+
+    def __init__(self, api_entry_point=OCR_ENTRY_POINT, max_in_flight=8, max_retries=3, retry_backoff=1.0,
+                 timeout=300, cache=None, limiter=None):
+        self.api_entry_point = api_entry_point
+        self.cache = cache
+        self.limiter = limiter
+        self.max_in_flight = max_in_flight
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_in_flight)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers.update({'Content-Type': 'application/json'})
+
+    def post(self, request_data):
+        """
+        :return: (response, latency) tuple, latency being the round trip without the wait for a limiter slot
+        """
+        # encoded before a limiter slot is taken, an unreadable image is not a service failure
+        request_body = json.dumps(encode_request_data(request_data))
+        if self.limiter is None:
+            start_time = time.time()
+            response = self.send(request_body)
+            return response, time.time() - start_time
+        self.limiter.acquire()
+        start_time = time.time()
+        try:
+            response = self.send(request_body)
+        except (requests.Timeout, requests.ConnectionError, OCRServiceError, ValueError):
+            self.limiter.release()
+            raise
+        except Exception:
+            self.limiter.release(time.time() - start_time)
+            raise
+        latency = time.time() - start_time
+        self.limiter.release(latency)
+        return response, latency
+
+    def send(self, request_body):
+        response = self.session.post(self.api_entry_point, data=request_body, timeout=self.timeout)
+        if response.status_code >= 500:
+            raise OCRServiceError('{} {}'.format(response.status_code, response.reason))
+        return json.loads(response.content.decode())
+
+    def query(self, page_n, request_data):
+        """
+        :param page_n: page number the request belongs to, passed through to the result
+        :param request_data: request body, see make_request_data
+        :return: OCRResult, error holds the last exception once every retry has failed, or at once when the
+                 page image cannot be read
+        """
+        start_time = time.time()
+        if self.cache is not None:
+            response = self.cache.get(request_data)
+            if response is not None:
+                return OCRResult(page_n, response, None, 0, time.time() - start_time, None)
+        attempts = 0
+        while True:
+            attempts += 1
+            try:
+                response, latency = self.post(request_data)
+                if self.cache is not None and isinstance(response, dict) and 'detections' in response:
+                    self.cache.put(request_data, response)
+                return OCRResult(page_n, response, None, attempts, time.time() - start_time, latency)
+            except (requests.RequestException, OCRServiceError, ValueError) as e:
+                if attempts > self.max_retries:
+                    return OCRResult(page_n, None, e, attempts, time.time() - start_time, None)
+                time.sleep(self.retry_backoff * 2 ** (attempts - 1))
+            except (IOError, OSError) as e:
+                # RequestExceptions are IOErrors too and are retried above, what is left is a page image that is
+                # missing or corrupt, which no retry fixes
+                return OCRResult(page_n, None, e, attempts, time.time() - start_time, None)
+
+    def iter_query_pages(self, page_requests):
+        """
+        Sends page requests with at most max_in_flight outstanding at once.
+        :param page_requests: iterable of (page_n, request_data) tuples
+        :return: generator of OCRResults in the order they complete
+        """
+        pool = ThreadPool(self.max_in_flight)
+        try:
+            for result in pool.imap_unordered(lambda page_request: self.query(*page_request), page_requests):
+                yield result
+        finally:
+            pool.terminate()
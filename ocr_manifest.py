@@ -0,0 +1,118 @@
+import os
+import json
+import time
+import tempfile
+
+from disk_cache import bytes_digest
+
+
+PENDING = 'pending'
+DONE = 'done'
+FAILED = 'failed'
+
+
+def response_digest(response):
+    return bytes_digest(json.dumps(response, sort_keys=True))
+
+
+class OCRJobManifest(object):
+    """
+    Per book record of every page's OCR status, attempt count, timing and response hash. The file is rewritten
+    atomically after each update, so a crashed run leaves an exact account of what finished, what failed and
+    what never ran, and a resumed run only schedules the pages that are not done.
+    """
+
+    def __init__(self, manifest_path, book_name=None):
+        self.manifest_path = manifest_path
+        self.book_name = book_name
+        self.pages = {}
+        if os.path.isfile(manifest_path):
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+            self.book_name = book_name or manifest['book_name']
+            self.pages = {int(page_n): page for page_n, page in manifest['pages'].items()}
+
+    @classmethod
+    def for_book(cls, annotation_dir, book_name):
+        return cls(os.path.join(annotation_dir, book_name + '.ocr_manifest'), book_name)
+
+    def page_status(self, page_n):
+        return self.pages.get(page_n, {}).get('status', PENDING)
+
+    def pending_pages(self, page_numbers):
+        return [page_n for page_n in page_numbers if self.page_status(page_n) != DONE]
+
+    def mark_done(self, page_n, response_hash=None, save=True):
+        """
+        Records a page completed outside this manifest, e.g. by a run from before manifests were kept.
+        """
+        self.pages[page_n] = {'status': DONE, 'attempts': 0, 'seconds': 0.0, 'response_hash': response_hash,
+                              'error': None, 'updated': time.time()}
+        if save:
+            self.save()
+
+    def mark_pending(self, page_n, save=True):
+        """
+        Schedules a page again, e.g. one whose annotation file has been deleted. Its attempt count is kept.
+        """
+        if page_n in self.pages:
+            self.pages[page_n]['status'] = PENDING
+            self.pages[page_n]['updated'] = time.time()
+        if save:
+            self.save()
+
+    def record(self, result, response_hash=None):
+        """
+        :param result: OCRResult of the page
+        :param response_hash: response_digest of the page's response, None when it failed
+        """
+        previous_attempts = self.pages.get(result.page_n, {}).get('attempts', 0)
+        self.pages[result.page_n] = {
+            'status': FAILED if result.error is not None else DONE,
+            'attempts': previous_attempts + result.attempts,
+            'seconds': result.seconds,
+            'response_hash': response_hash,
+            'error': repr(result.error) if result.error is not None else None,
+            'updated': time.time()
+        }
+        self.save()
+
+    def save(self):
+        manifest = {'book_name': self.book_name, 'pages': {str(page_n): page for page_n, page in self.pages.items()}}
+        manifest_dir = os.path.dirname(os.path.abspath(self.manifest_path))
+        fd, tmp_path = tempfile.mkstemp(dir=manifest_dir, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            json.dump(manifest, f)
+        os.rename(tmp_path, self.manifest_path)
+
+    def progress(self, page_numbers):
+        counts = {PENDING: 0, DONE: 0, FAILED: 0}
+        for page_n in page_numbers:
+            counts[self.page_status(page_n)] += 1
+        return counts
+
+
+class ProgressReporter(object):
+    """
+    Prints one line per finished page with the run's progress and an ETA from its pace so far.
+    """
+
+    def __init__(self, book_name, n_pages):
+        self.book_name = book_name
+        self.n_pages = n_pages
+        self.n_finished = 0
+        self.n_failed = 0
+        self.start_time = time.time()
+
+    def eta_seconds(self):
+        if not self.n_finished:
+            return None
+        return (time.time() - self.start_time) / self.n_finished * (self.n_pages - self.n_finished)
+
+    def update(self, result):
+        self.n_finished += 1
+        if result.error is not None:
+            self.n_failed += 1
+        status = 'ocr service error: {}'.format(result.error) if result.error is not None else 'done'
+        print('%s page %d %s, %d/%d finished, %d failed, eta %ds' % (
+            self.book_name, result.page_n, status, self.n_finished, self.n_pages, self.n_failed, self.eta_seconds()))
@@ -6,20 +6,22 @@ from binascii import b2a_hex
 import PIL.Image as Image
 import io
 import glob
+from itertools import chain
+from multiprocessing.pool import ThreadPool
 
 from collections import OrderedDict
 from collections import defaultdict
 import pdfminer
-from pdfminer.pdfparser import PDFParser
-from pdfminer.pdfdocument import PDFDocument
-from pdfminer.pdfpage import PDFPage
-from pdfminer.pdfinterp import PDFResourceManager
-from pdfminer.pdfinterp import PDFPageInterpreter
 from pdfminer.layout import LAParams
-from pdfminer.converter import PDFPageAggregator
 
 from annotation_schema import page_schema
 from amt_boto_modules import load_local_annotation
+from page_layouts import iter_page_layouts
+from ocr_client import OCRResult, OCRClient, OCRCache, OCR_ENTRY_POINT, make_request_data, encode_request_data
+from image_dims import probe_image_size, image_dim_index, indexed_image_size
+from ocr_tiles import tile_page_jobs, iter_query_page_crops, merge_tile_results, merge_figure_results
+from ocr_manifest import OCRJobManifest, ProgressReporter, response_digest, PENDING, DONE, FAILED
+from text_layer import iter_text_layer_tables, text_layer_response, figure_image_boxes
 
 
 def determine_image_type (stream_first_4_bytes):
@@ -140,21 +142,32 @@ def write_annotation_file(ocr_results, page_n, book, annotations_folder):
     return
 
 
-def query_vision_ocr(image_url, merge_boxes=False, include_merged_components=False, as_json=True):
+def uploads_images(api_entry_point, upload_images=False):
+    """
+    Page images are only posted to a service of our own, the public OCR_ENTRY_POINT is sent their s3 urls
+    unless upload_images asks otherwise.
+    """
+    return upload_images or api_entry_point != OCR_ENTRY_POINT
+
+
+def query_vision_ocr(image_url, merge_boxes=False, include_merged_components=False, as_json=True, image_path=None,
+                     image_size=None, api_entry_point=OCR_ENTRY_POINT, upload_images=False):
+    """
+    :param image_url: url of the page image, what is sent unless image_path is uploaded
+    :param image_path: local copy of the page image, its bytes are posted instead of the url when uploads_images
+    :param image_size: known (width, height) of the image, printed when given
+    :param api_entry_point: OCR service to post to
+    :param upload_images: post image_path even to the public OCR_ENTRY_POINT
+    """
     print image_url
-    req = requests.get(image_url)
-    tpi = Image.open(io.BytesIO(req.content))
-    print(tpi.info, tpi.size, tpi.size[0]*tpi.size[1])
-    api_entry_point = 'http://vision-ocr.dev.allenai.org/v1/ocr'
+    if image_size is not None:
+        print(image_size, image_size[0]*image_size[1])
     header = {'Content-Type': 'application/json'}
-    request_data = {
-        'url': image_url,
-        # 'maximumSizePixels': max_pix_size,
-        'mergeBoxes': merge_boxes,
-        'includeMergedComponents': include_merged_components
-    }
-
-    json_data = json.dumps(request_data)
+    if not uploads_images(api_entry_point, upload_images):
+        image_path = None
+    request_data = make_request_data(image_url, merge_boxes, include_merged_components, image_path)
+
+    json_data = json.dumps(encode_request_data(request_data))
     response = requests.post(api_entry_point, data=json_data, headers=header)
     print(response.reason)
     json_response = json.loads(response.content.decode())
@@ -167,41 +180,34 @@ def process_book(pdf_file, page_range, line_overlap,
                  char_margin,
                  line_margin,
                  word_margin,
-                 boxes_flow):
+                 boxes_flow,
+                 n_workers=1,
+                 cache=None):
     line_overlap = 0.5
     source_dir = 'pdfs/'
     book_name = pdf_file.replace('.pdf', '')
     laparams = LAParams(line_overlap, char_margin, line_margin, word_margin, boxes_flow)
 
-    with open(source_dir + pdf_file, 'r') as fp:
-        parser = PDFParser(fp)
-        document = PDFDocument(parser)
-        rsrcmgr = PDFResourceManager()
-        device = PDFPageAggregator(rsrcmgr, laparams=laparams)
-        interpreter = PDFPageInterpreter(rsrcmgr, device)
-
-        for page_n, page in enumerate(PDFPage.create_pages(document)):
-            if not page_range or (page_range[0] <= page_n <= page_range[1]):
-                interpreter.process_page(page)
-                layout = device.get_result()
-                write_image_file(layout, page_n, book_name, 'smaller_page_images', 0.66)
+    for page_n, layout in iter_page_layouts(source_dir + pdf_file, page_range, laparams, n_workers, cache=cache):
+        write_image_file(layout, page_n, book_name, 'smaller_page_images', 0.66)
 
 
-def add_anno_img_dim(img_dir, source_annotation_folder, dest_annotation_folder):
+def add_anno_img_dim(img_dir, source_annotation_folder, dest_annotation_folder, n_workers=16):
     """
     Adds a field to the box annotations for the vertical dimension of the page image
     :param img_dir: dir to read images from and set dim
     :param source_annotation_folder dir to read source annotations from
     :param dest_annotation_folder: destination for the new annotation files
+    :param n_workers: threads reading image headers into the directory's ImageDimIndex
     :return: None
     """
+    dim_index = image_dim_index(img_dir).build('Read*', n_workers)
     for img in glob.glob(img_dir + '/Read*'):
         img_name = img.rsplit('/')[-1]
         anno_file_name = img_name.replace('jpeg', 'json')
         try:
             existing_annotations = load_local_annotation(img_name, source_annotation_folder)
-            with open(img) as f:
-                v_dim = record_image_size(f.read())[1]
+            v_dim = dim_index.size(img)[1]
             try:
                 for box_name, box in existing_annotations['text'].items():
                     box['v_dim'] = v_dim
@@ -218,6 +224,11 @@ def assemble_url(page_number, book_name, base_url):
     return base_url + book_name.replace('+', '%2B') + '_' + str(page_number) + '.jpeg'
 
 
+def local_page_image(image_dir, page_number, book_name):
+    image_path = os.path.join(image_dir, book_name + '_' + str(page_number) + '.jpeg')
+    return image_path if os.path.isfile(image_path) else None
+
+
 def check_response(url):
     response = requests.get(url)
     if response.status_code == 200:
@@ -226,22 +237,169 @@ def check_response(url):
         return False
 
 
-def perform_ocr(pdf_file, annotation_dir, (start_n, stop_n)):
-    book_name = pdf_file.replace('.pdf', '')
+def page_image_size(image_path, image_url, session=None):
+    return indexed_image_size(image_path) if image_path else probe_image_size(image_url, session)
 
-    base_url = 'https://s3-us-west-2.amazonaws.com/ai2-vision-turk-data/textbook-annotation-test/smaller-page-images/'
 
-    page_n = start_n
-    while page_n <= stop_n:
-        file_ext = ".json"
-        file_path = annotation_dir + '/' + book_name + '_' + str(page_n) + file_ext
-        if not os.path.isfile(file_path):
+def try_page_image_size(page_job, session=None):
+    """
+    :param page_job: (page_n, image_path, image_url) tuple
+    :return: ((width, height), None) of the page job's image, or (None, the IOError or OSError reading it)
+    """
+    _, image_path, image_url = page_job
+    try:
+        return page_image_size(image_path, image_url, session), None
+    except (IOError, OSError) as e:
+        return None, e
 
-            print(book_name, page_n)
-            try:
-                print(assemble_url(page_n, book_name, base_url))
-                ocr_response = query_vision_ocr(assemble_url(page_n, book_name, base_url))
-                write_annotation_file(ocr_response, page_n, book_name, annotation_dir)
-            except ValueError:
-                print('ocr service error')
-        page_n += 1
+
+def page_image_sizes(page_jobs, session=None, n_threads=8):
+    """
+    :param page_jobs: (page_n, image_path, image_url) tuples
+    :return: list of the (image_size, error) of each page job's image, see try_page_image_size, remote images
+             probed n_threads at a time
+    """
+    if n_threads <= 1 or len(page_jobs) < 2:
+        return [try_page_image_size(page_job, session) for page_job in page_jobs]
+    pool = ThreadPool(n_threads)
+    try:
+        return pool.map(lambda page_job: try_page_image_size(page_job, session), page_jobs)
+    finally:
+        pool.terminate()
+
+
+def split_text_layer_pages(pdf_path, page_jobs, laparams, session=None, n_workers=1, layout_cache=None,
+                           ocr_figures=False, min_figure_size=32, n_probes=8):
+    """
+    Builds responses from the pdf text layer for the pages of page_jobs that have a usable one.
+    :param page_jobs: (page_n, image_path, image_url) tuples, the page image sets the annotation's pixel scale
+    :param ocr_figures: also find the pixel boxes of each text layer page's figures, for OCR
+    :param n_probes: threads reading the sizes of the text layer pages' images
+    :return: dict of page_n to (page_job, text layer response, figure boxes) for the text layer pages, the
+             page_jobs left for OCR, and failed OCRResults for the text layer pages whose image cannot be sized
+    """
+    page_jobs_by_n = dict((page_job[0], page_job) for page_job in page_jobs)
+    text_layer_tables = []
+    ocr_jobs = []
+    for page_n, table in iter_text_layer_tables(pdf_path, sorted(page_jobs_by_n), laparams, n_workers, layout_cache):
+        if table is None:
+            ocr_jobs.append(page_jobs_by_n[page_n])
+        else:
+            text_layer_tables.append((page_jobs_by_n[page_n], table))
+
+    image_sizes = page_image_sizes([page_job for page_job, _ in text_layer_tables], session, n_probes)
+    text_layer_pages = {}
+    failed_results = []
+    for (page_job, table), (image_size, error) in zip(text_layer_tables, image_sizes):
+        if error is not None:
+            failed_results.append(OCRResult(page_job[0], None, error, 0, 0.0, None))
+            continue
+        figure_boxes = figure_image_boxes(table, image_size, min_figure_size) if ocr_figures else []
+        text_layer_pages[page_job[0]] = (page_job, text_layer_response(table, image_size), figure_boxes)
+    return text_layer_pages, ocr_jobs, failed_results
+
+
+def perform_ocr(pdf_file, annotation_dir, (start_n, stop_n), client=None, image_dir=None, overwrite=False,
+                tile_size=None, tile_overlap=256, text_layer=False, pdf_dir='pdfs/', laparams=None,
+                layout_cache=None, n_workers=1, ocr_figures=False, upload_images=False, cache_dir=None):
+    """
+    OCRs every page of a book not yet done, keeping up to client.max_in_flight requests outstanding and writing
+    each annotation as soon as its response arrives. Progress is kept in a job manifest beside the annotations,
+    so an interrupted run resumes with just its pending and failed pages.
+    :param client: OCRClient to send requests through, a default client when None
+    :param image_dir: local page images, as written by process_book. They size the text layer pages, and are
+                      uploaded instead of sending s3 urls when the client's service is not the public
+                      OCR_ENTRY_POINT or upload_images is set
+    :param overwrite: redo every page in the range, cheap when the client has an OCRCache
+    :param tile_size: OCR uploaded images larger than this many pixels a side as overlapping tiles, None sends them
+                      whole
+    :param tile_overlap: pixels neighbouring tiles share
+    :param text_layer: annotate pages with a usable text layer from the pdf in pdf_dir, only OCR the rest
+    :param laparams: pdfminer LAParams for the text layer, pdfminer's defaults when None
+    :param layout_cache: optional LayoutCache for the text layer
+    :param n_workers: worker processes laying out the text layer
+    :param ocr_figures: with text_layer, also OCR the figures of text layer pages, whose text pdfminer cannot see,
+                        and merge it into their annotations. Only the figure crops of uploaded page images are
+                        sent, other pages are sent whole and keep just the detections inside their figures.
+    :param upload_images: upload image_dir's images even to the public OCR_ENTRY_POINT
+    :param cache_dir: directory of an OCRCache for the default client, which caches nothing when None
+    :return: OCRResults of the pages sent, in the order they completed, without their responses
+    """
+    if tile_size and tile_size <= tile_overlap:
+        raise ValueError('tile_size {} must be larger than tile_overlap {}'.format(tile_size, tile_overlap))
+    book_name = pdf_file.replace('.pdf', '')
+
+    base_url = 'https://s3-us-west-2.amazonaws.com/ai2-vision-turk-data/textbook-annotation-test/smaller-page-images/'
+    if client is None:
+        client = OCRClient(cache=OCRCache(cache_dir) if cache_dir else None)
+    upload = uploads_images(client.api_entry_point, upload_images)
+
+    manifest = OCRJobManifest.for_book(annotation_dir, book_name)
+    page_numbers = range(start_n, stop_n + 1)
+    annotation_files = set(os.listdir(annotation_dir)) if os.path.isdir(annotation_dir) else set()
+    for page_n in page_numbers:
+        is_annotated = book_name + '_' + str(page_n) + ".json" in annotation_files
+        page_status = manifest.page_status(page_n)
+        if page_status == PENDING and is_annotated:
+            # annotated by a run from before the manifest was kept
+            manifest.mark_done(page_n, save=False)
+        elif page_status == DONE and not is_annotated:
+            # deleting a page's annotation is how it is redone
+            manifest.mark_pending(page_n, save=False)
+    manifest.save()
+
+    if image_dir and (tile_size and upload or text_layer):
+        # one pass over the book's image headers, a miss in indexed_image_size saves the whole index again
+        image_dim_index(image_dir).build(book_name + '_*.jpeg')
+
+    page_jobs = []
+    for page_n in page_numbers if overwrite else manifest.pending_pages(page_numbers):
+        image_path = local_page_image(image_dir, page_n, book_name) if image_dir else None
+        page_jobs.append((page_n, image_path, assemble_url(page_n, book_name, base_url)))
+    n_pages = len(page_jobs)
+    text_layer_pages = {}
+    failed_results = []
+    if text_layer:
+        text_layer_pages, page_jobs, failed_results = split_text_layer_pages(pdf_dir + pdf_file, page_jobs,
+                                                                             laparams or LAParams(), client.session,
+                                                                             n_workers, layout_cache, ocr_figures,
+                                                                             n_probes=client.max_in_flight)
+    if not upload:
+        # the local images still sized the text layer pages, but only their urls are sent
+        page_jobs = [(page_n, None, image_url) for page_n, _, image_url in page_jobs]
+        text_layer_pages = dict((page_n, ((page_n, None, image_url), text_response, figure_boxes))
+                                for page_n, ((_, _, image_url), text_response, figure_boxes)
+                                in text_layer_pages.items())
+    page_crop_jobs, unreadable_results = tile_page_jobs(page_jobs, tile_size, tile_overlap)
+    failed_results.extend(unreadable_results)
+    text_layer_results = []
+    for page_n, ((_, image_path, image_url), text_response, figure_boxes) in sorted(text_layer_pages.items()):
+        if figure_boxes:
+            page_crop_jobs.append((page_n, image_path, image_url, figure_boxes if image_path else [None]))
+        else:
+            text_layer_results.append(OCRResult(page_n, text_response, None, 0, 0.0, None))
+
+    def merge_page(page_n, crops, crop_results):
+        if page_n in text_layer_pages:
+            _, text_response, figure_boxes = text_layer_pages[page_n]
+            return merge_figure_results(page_n, text_response, figure_boxes, crops, crop_results)
+        return merge_tile_results(page_n, crops, crop_results)
+
+    page_results = (merge_page(*page_crops) for page_crops in iter_query_page_crops(client, page_crop_jobs))
+    progress = manifest.progress(page_numbers)
+    print('%s: %d pages done, %d failed, %d from the text layer, %d of them with figures to OCR, %d to OCR whole, '
+          '%d with unreadable images' % (book_name, progress[DONE], progress[FAILED], len(text_layer_pages),
+                                         len(text_layer_pages) - len(text_layer_results),
+                                         len(page_jobs) - len(unreadable_results), len(failed_results)))
+
+    reporter = ProgressReporter(book_name, n_pages)
+    results = []
+    for result in chain(failed_results, text_layer_results, page_results):
+        if result.error is not None:
+            manifest.record(result)
+        else:
+            write_annotation_file(result.response, result.page_n, book_name, annotation_dir)
+            manifest.record(result, response_digest(result.response))
+        reporter.update(result)
+        results.append(result._replace(response=None))
+    return results
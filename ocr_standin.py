@@ -0,0 +1,226 @@
+import argparse
+import base64
+import io
+import json
+import random
+import shutil
+import tempfile
+import threading
+import time
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+import numpy as np
+import PIL.Image as Image
+
+from ocr_client import OCRClient, AdaptiveLimiter
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        return
+
+    def send_body(self, status, body, content_type='application/json'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        standin = self.server.standin
+        if self.path.rstrip('/') != '/v1/ocr':
+            self.send_body(404, json.dumps({'error': 'not found'}))
+            return
+        try:
+            request_data = json.loads(self.rfile.read(int(self.headers.getheader('Content-Length', 0))))
+        except ValueError:
+            self.send_body(400, json.dumps({'error': 'request is not json'}))
+            return
+        status, body, content_type = standin.respond(request_data)
+        self.send_body(status, body, content_type)
+
+
+class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class OCRStandIn(object):
+    """
+    Local HTTP server speaking the vision-ocr /v1/ocr request and response shape, for load testing the OCR pipeline
+    offline. Each request sleeps for a sampled latency and then fails with a 503, answers with a body that is not
+    JSON, or returns synthetic detections seeded by the page image, so a given page always gets the same boxes.
+    With a capacity, more concurrent requests than that slow every request down proportionally and are
+    increasingly answered with 503s, like an overloaded service.
+    """
+
+    def __init__(self, port=0, latency=0.2, latency_jitter=0.1, error_rate=0.0, bad_json_rate=0.0, n_detections=20,
+                 seed=None, capacity=None):
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.bad_json_rate = bad_json_rate
+        self.n_detections = n_detections
+        self.capacity = capacity
+        self.n_active = 0
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.n_requests = 0
+        self.n_failed = 0
+        self.server = ThreadedHTTPServer(('127.0.0.1', port), StandInHandler)
+        self.server.standin = self
+        self.thread = None
+
+    @property
+    def url(self):
+        return 'http://{}:{}/v1/ocr'.format(*self.server.server_address)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self.url
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def respond(self, request_data):
+        with self.lock:
+            self.n_requests += 1
+            self.n_active += 1
+            overload = self.n_active / float(self.capacity) if self.capacity else 1.0
+            latency = max(0.0, self.rng.gauss(self.latency, self.latency_jitter)) * max(1.0, overload)
+            outcome = self.rng.random()
+        try:
+            time.sleep(latency)
+        finally:
+            with self.lock:
+                self.n_active -= 1
+        if overload > 1 and self.rng.random() > 1 / overload:
+            with self.lock:
+                self.n_failed += 1
+            return 503, 'Service Unavailable', 'text/plain'
+        if outcome < self.error_rate:
+            with self.lock:
+                self.n_failed += 1
+            return 503, 'Service Unavailable', 'text/plain'
+        if outcome < self.error_rate + self.bad_json_rate:
+            with self.lock:
+                self.n_failed += 1
+            return 200, '<html>upstream timed out</html>', 'text/html'
+        try:
+            response = self.make_response(request_data)
+        except (TypeError, ValueError, IOError):
+            # bad base64 or bytes PIL cannot open, the request's fault rather than the service's
+            return 400, json.dumps({'error': 'image cannot be decoded'}), 'application/json'
+        return 200, json.dumps(response), 'application/json'
+
+    def make_response(self, request_data):
+        if 'image' in request_data:
+            image_bytes = base64.b64decode(request_data['image'])
+            width, height = Image.open(io.BytesIO(image_bytes)).size
+            page_rng = random.Random(image_bytes)
+        else:
+            width, height = 1000, 1400
+            page_rng = random.Random(request_data.get('url'))
+        detections = []
+        for _ in range(self.n_detections):
+            box_width = page_rng.randint(20, max(21, width // 3))
+            box_height = page_rng.randint(10, 40)
+            x = page_rng.randint(0, max(0, width - box_width))
+            y = page_rng.randint(0, max(0, height - box_height))
+            detections.append({
+                'value': ' '.join('word{}'.format(page_rng.randint(0, 999)) for _ in range(page_rng.randint(1, 6))),
+                'score': round(page_rng.uniform(0.5, 1.0), 4),
+                'rectangle': [{'x': x, 'y': y}, {'x': x + box_width, 'y': y + box_height}]
+            })
+        return {'detections': detections}
+
+
+def summarize_ocr_results(results, wall_seconds):
+    """
+    :param results: OCRResults of one run
+    :param wall_seconds: wall clock time of the run
+    :return: dict of throughput, request latency and page completion time percentiles in seconds and retry counts
+    """
+    sent = [result for result in results if result.attempts > 0]
+    seconds = np.array([result.seconds for result in sent]) if sent else np.zeros(1)
+    latencies = [result.latency for result in results if result.latency is not None]
+    latencies = np.array(latencies) if latencies else np.zeros(1)
+    return {
+        'pages': len(results),
+        'pages_per_second': len(results) / wall_seconds if wall_seconds else float('inf'),
+        'p50_latency': float(np.percentile(latencies, 50)),
+        'p99_latency': float(np.percentile(latencies, 99)),
+        'p50_page_seconds': float(np.percentile(seconds, 50)),
+        'p99_page_seconds': float(np.percentile(seconds, 99)),
+        'retries': sum(max(result.attempts - 1, 0) for result in results),
+        'failed_pages': sum(1 for result in results if result.error is not None),
+        'cache_hits': sum(1 for result in results if result.attempts == 0)
+    }
+
+
+def benchmark_ocr(n_pages=200, max_in_flight=8, max_retries=3, latency=0.2, latency_jitter=0.1, error_rate=0.05,
+                  bad_json_rate=0.0, n_detections=20, cache=None, seed=0, capacity=None, adaptive=False):
+    """
+    Runs perform_ocr over a synthetic book against a local stand-in and reports how it went. Annotations go to a
+    temporary directory that is removed afterwards.
+    :param cache: OCRCache for the client, None benchmarks uncached requests. The synthetic pages are sent by url,
+                  so only a cache with cache_urls set answers them
+    :param capacity: concurrent requests the stand-in serves before it degrades, None for unlimited
+    :param adaptive: let an AdaptiveLimiter capped at max_in_flight pick the concurrency
+    :return: dict from summarize_ocr_results, plus the requests the stand-in saw and the limiter's final limit
+    """
+    import ocr_pipeline
+
+    annotation_dir = tempfile.mkdtemp(prefix='ocr_benchmark_')
+    try:
+        with OCRStandIn(latency=latency, latency_jitter=latency_jitter, error_rate=error_rate,
+                        bad_json_rate=bad_json_rate, n_detections=n_detections, seed=seed,
+                        capacity=capacity) as standin:
+            limiter = AdaptiveLimiter(min(4, max_in_flight), max_limit=max_in_flight) if adaptive else None
+            client = OCRClient(standin.url, max_in_flight=max_in_flight, max_retries=max_retries,
+                               retry_backoff=0.05, cache=cache, limiter=limiter)
+            start_time = time.time()
+            results = ocr_pipeline.perform_ocr('benchmark_book.pdf', annotation_dir, (0, n_pages - 1), client=client,
+                                               overwrite=True)
+            stats = summarize_ocr_results(results, time.time() - start_time)
+            stats['service_requests'] = standin.n_requests
+            stats['final_limit'] = int(limiter.limit) if limiter else max_in_flight
+    finally:
+        shutil.rmtree(annotation_dir)
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the OCR pipeline against a local vision-ocr stand-in')
+    parser.add_argument('--pages', type=int, default=200)
+    parser.add_argument('--in-flight', type=int, default=8)
+    parser.add_argument('--latency', type=float, default=0.2)
+    parser.add_argument('--jitter', type=float, default=0.1)
+    parser.add_argument('--error-rate', type=float, default=0.05)
+    parser.add_argument('--bad-json-rate', type=float, default=0.0)
+    parser.add_argument('--capacity', type=int, default=None)
+    parser.add_argument('--adaptive', action='store_true')
+    args = parser.parse_args()
+
+    stats = benchmark_ocr(args.pages, args.in_flight, latency=args.latency, latency_jitter=args.jitter,
+                          error_rate=args.error_rate, bad_json_rate=args.bad_json_rate, capacity=args.capacity,
+                          adaptive=args.adaptive)
+    for stat_name in ['pages', 'pages_per_second', 'p50_latency', 'p99_latency', 'p50_page_seconds',
+                      'p99_page_seconds', 'retries', 'failed_pages', 'cache_hits', 'service_requests', 'final_limit']:
+        print('%s: %s' % (stat_name, stats[stat_name]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+from collections import defaultdict
+
+import numpy as np
+
+from image_dims import indexed_image_size
+from ocr_client import OCRResult, make_request_data
+
+
+def tile_starts(length, tile_size, overlap):
+    if length <= tile_size:
+        return [0]
+    step = tile_size - overlap
+    starts = list(range(0, length - tile_size, step))
+    return starts + [length - tile_size]
+
+
+def tile_boxes(width, height, tile_size=2048, overlap=256):
+    """
+    Covers an image with tiles of at most tile_size pixels a side, neighbours sharing an overlap pixel band so
+    text cut by one tile's edge lies whole in the next. The last row and column are aligned to the image edge.
+    :return: list of (left, top, right, bottom) tile boxes, a single None when one tile covers the whole image
+    """
+    if tile_size <= overlap:
+        raise ValueError('tile_size {} must be larger than the tile overlap {}'.format(tile_size, overlap))
+    if width <= tile_size and height <= tile_size:
+        return [None]
+    return [(left, top, min(left + tile_size, width), min(top + tile_size, height))
+            for top in tile_starts(height, tile_size, overlap) for left in tile_starts(width, tile_size, overlap)]
+
+
+def offset_detection(detection, left, top):
+    detection = dict(detection)
+    detection['rectangle'] = [{'x': point['x'] + left, 'y': point['y'] + top} for point in detection['rectangle']]
+    return detection
+
+
+def detection_bboxes(detections):
+    """
+    :return: float64 array of shape (n, 4) of (x0, y0, x1, y1) spanning each detection's rectangle points
+    """
+    bboxes = np.zeros((len(detections), 4))
+    for det_n, detection in enumerate(detections):
+        xs = [point['x'] for point in detection['rectangle']]
+        ys = [point['y'] for point in detection['rectangle']]
+        bboxes[det_n] = min(xs), min(ys), max(xs), max(ys)
+    return bboxes
+
+
+def dedupe_tile_detections(detections, tile_ns, containment=0.7):
+    """
+    Drops detections repeated by neighbouring tiles in their shared overlap band. Larger boxes are kept first, so
+    a word whole in one tile wins over the fragment cut by the other tile's edge. A detection is dropped when
+    containment of its area lies inside a kept detection from a different tile.
+    :param detections: detections in page coordinates
+    :param tile_ns: tile each detection came from
+    :return: kept detections, in their original order
+    """
+    if not detections:
+        return []
+    bboxes = detection_bboxes(detections)
+    tile_ns = np.asarray(tile_ns)
+    areas = np.maximum(bboxes[:, 2] - bboxes[:, 0], 0) * np.maximum(bboxes[:, 3] - bboxes[:, 1], 0)
+    kept = []
+    for det_n in np.argsort(-areas, kind='mergesort'):
+        if kept:
+            kept_n = np.array(kept)
+            other_tile = kept_n[tile_ns[kept_n] != tile_ns[det_n]]
+            if len(other_tile):
+                inter_w = np.minimum(bboxes[other_tile, 2], bboxes[det_n, 2]) - \
+                    np.maximum(bboxes[other_tile, 0], bboxes[det_n, 0])
+                inter_h = np.minimum(bboxes[other_tile, 3], bboxes[det_n, 3]) - \
+                    np.maximum(bboxes[other_tile, 1], bboxes[det_n, 1])
+                inter = np.maximum(inter_w, 0) * np.maximum(inter_h, 0)
+                if (inter > containment * max(areas[det_n], 1e-9)).any():
+                    continue
+        kept.append(det_n)
+    return [detections[det_n] for det_n in sorted(kept)]
+
+
+def covered_detections(detections, boxes, containment=0.7):
+    """
+    :param boxes: array-like of shape (m, 4) of (x0, y0, x1, y1) boxes in the detections' coordinates
+    :return: bool array, True for each detection with more than containment of its area inside one of the boxes
+    """
+    bboxes = detection_bboxes(detections)
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    inter_w = np.minimum(bboxes[:, None, 2], boxes[None, :, 2]) - np.maximum(bboxes[:, None, 0], boxes[None, :, 0])
+    inter_h = np.minimum(bboxes[:, None, 3], boxes[None, :, 3]) - np.maximum(bboxes[:, None, 1], boxes[None, :, 1])
+    inter = np.maximum(inter_w, 0) * np.maximum(inter_h, 0)
+    areas = np.maximum(bboxes[:, 2] - bboxes[:, 0], 0) * np.maximum(bboxes[:, 3] - bboxes[:, 1], 0)
+    return (inter > containment * np.maximum(areas, 1e-9)[:, None]).any(axis=1)
+
+
+def merge_tile_results(page_n, crops, tile_results):
+    """
+    :param crops: the page's tile boxes from tile_boxes
+    :param tile_results: OCRResults of the page's tiles keyed by tile number
+    :return: one OCRResult for the whole page, failed if any tile failed
+    """
+    attempts = sum(result.attempts for result in tile_results.values())
+    seconds = max(result.seconds for result in tile_results.values())
+    latency = max([result.latency for result in tile_results.values() if result.latency is not None] or [None])
+    errors = [result.error for result in tile_results.values() if result.error is not None]
+    if errors:
+        return OCRResult(page_n, None, errors[0], attempts, seconds, latency)
+    if crops == [None]:
+        return OCRResult(page_n, tile_results[0].response, None, attempts, seconds, latency)
+
+    detections = []
+    tile_ns = []
+    for tile_n, crop in enumerate(crops):
+        for detection in tile_results[tile_n].response.get('detections', []):
+            detections.append(offset_detection(detection, crop[0], crop[1]))
+            tile_ns.append(tile_n)
+    return OCRResult(page_n, {'detections': dedupe_tile_detections(detections, tile_ns)}, None, attempts, seconds,
+                     latency)
+
+
+def merge_figure_results(page_n, text_response, figure_boxes, crops, figure_results, containment=0.7):
+    """
+    Adds the OCRed text of a page's figures to the response built from its pdf text layer. Figures cropped from a
+    local image are shifted back into page coordinates, a page sent whole keeps only the detections inside its
+    figures. OCR detections mostly covered by a text layer line are dropped, the text layer's text is exact.
+    :param text_response: response from text_layer_response
+    :param figure_boxes: (left, top, right, bottom) pixel boxes of the page's figures
+    :param crops: the figure crops sent, figure_boxes or [None] for the whole page
+    :param figure_results: OCRResults of the crops keyed by crop number
+    :return: one OCRResult for the whole page, failed if any crop failed
+    """
+    merged = merge_tile_results(page_n, crops, figure_results)
+    if merged.error is not None:
+        return merged
+    detections = merged.response.get('detections', [])
+    if crops == [None]:
+        detections = [detection for detection, inside in
+                      zip(detections, covered_detections(detections, figure_boxes, containment)) if inside]
+    text_detections = text_response['detections']
+    text_bboxes = detection_bboxes(text_detections)
+    detections = [detection for detection, covered in
+                  zip(detections, covered_detections(detections, text_bboxes, containment)) if not covered]
+    return merged._replace(response={'detections': text_detections + detections})
+
+
+def page_tiles(image_path, tile_size=None, overlap=256):
+    """
+    :return: tile boxes of a local page image, [None] when there is no local image or no tile_size to split it by
+    """
+    if not image_path or not tile_size:
+        return [None]
+    return tile_boxes(*indexed_image_size(image_path), tile_size=tile_size, overlap=overlap)
+
+
+def tile_page_jobs(page_jobs, tile_size=None, overlap=256):
+    """
+    :param page_jobs: iterable of (page_n, image_path, image_url) tuples
+    :return: list of (page_n, image_path, image_url, tiles) page crop jobs, and failed OCRResults for the pages whose
+             local image cannot be read, so one bad image fails just its own page
+    """
+    page_crop_jobs = []
+    failed_results = []
+    for page_n, image_path, image_url in page_jobs:
+        try:
+            page_crop_jobs.append((page_n, image_path, image_url, page_tiles(image_path, tile_size, overlap)))
+        except (IOError, OSError) as e:
+            failed_results.append(OCRResult(page_n, None, e, 0, 0.0, None))
+    return page_crop_jobs, failed_results
+
+
+def iter_query_page_crops(client, page_crop_jobs, merge_boxes=False, include_merged_components=False):
+    """
+    Sends pages as one request per crop, every crop of every page sharing the client's concurrency.
+    :param client: OCRClient
+    :param page_crop_jobs: iterable of (page_n, image_path, image_url, crops) tuples, a None crop sends the whole
+                           image, by url when there is no local image_path
+    :return: generator of (page_n, crops, {crop_n: OCRResult}) tuples in the order pages complete
+    """
+    page_crops = {}
+    crop_requests = []
+    for page_n, image_path, image_url, crops in page_crop_jobs:
+        page_crops[page_n] = crops
+        for crop_n, crop in enumerate(crops):
+            crop_requests.append(((page_n, crop_n), make_request_data(image_url, merge_boxes, include_merged_components,
+                                                                      image_path, crop)))
+
+    page_crop_results = defaultdict(dict)
+    for result in client.iter_query_pages(crop_requests):
+        page_n, crop_n = result.page_n
+        page_crop_results[page_n][crop_n] = result
+        if len(page_crop_results[page_n]) == len(page_crops[page_n]):
+            yield page_n, page_crops.pop(page_n), page_crop_results.pop(page_n)
+
+
+def iter_query_tiled_pages(client, page_jobs, tile_size=2048, overlap=256, merge_boxes=False,
+                           include_merged_components=False):
+    """
+    OCRs pages as overlapping tiles, every tile of every page sharing the client's concurrency, and stitches each
+    page's detections back into page coordinates once its last tile is in.
+    :param client: OCRClient
+    :param page_jobs: iterable of (page_n, image_path, image_url) tuples, pages without a local image_path are
+                      sent whole by url
+    :return: generator of page OCRResults in the order pages complete, pages whose image cannot be read first
+    """
+    page_crop_jobs, failed_results = tile_page_jobs(page_jobs, tile_size, overlap)
+    for result in failed_results:
+        yield result
+    for page_n, crops, tile_results in iter_query_page_crops(client, page_crop_jobs, merge_boxes,
+                                                             include_merged_components):
+        yield merge_tile_results(page_n, crops, tile_results)
@@ -0,0 +1,661 @@
+import copy_reg
+import cPickle as pickle
+import math
+import zlib
+import multiprocessing
+from collections import deque
+from itertools import islice
+
+from pdfminer.psparser import PSLiteral, PSKeyword, LIT, KWD
+from pdfminer.pdftypes import PDFObjRef, PDFStream
+from pdfminer.pdftypes import int_value, list_value, dict_value
+from pdfminer.pdfparser import PDFParser
+from pdfminer.pdfdocument import PDFDocument
+from pdfminer.pdfpage import PDFPage, LITERAL_PAGE, LITERAL_PAGES
+from pdfminer.pdfinterp import PDFResourceManager
+from pdfminer.pdfinterp import PDFPageInterpreter
+from pdfminer.pdfinterp import LITERAL_FORM, LITERAL_IMAGE
+from pdfminer.pdfdevice import PDFDevice
+from pdfminer.pdftypes import stream_value
+from pdfminer.psparser import literal_name
+from pdfminer.utils import MATRIX_IDENTITY, mult_matrix, apply_matrix_pt
+from pdfminer.layout import LTContainer, LTImage, LTFigure
+from pdfminer.converter import PDFPageAggregator
+
+from disk_cache import DiskCache, file_digest
+from layout_table import LayoutTable
+
+
+def intern_literal(name):
+    return LIT(name)
+
+
+def intern_keyword(name):
+    return KWD(name)
+
+
+# pdfminer compares literals and keywords by identity, so they have to be re-interned when layouts cross processes
+copy_reg.pickle(PSLiteral, lambda literal: (intern_literal, (literal.name,)))
+copy_reg.pickle(PSKeyword, lambda keyword: (intern_keyword, (keyword.name,)))
+
+
+class PageIndex(object):
+    """
+    Resolves zero indexed page numbers to pdfminer PDFPage objects without enumerating the whole page tree.
+    Subtrees that end before the requested page are skipped using their /Count entry.
+    """
+
+    def __init__(self, document):
+        self.document = document
+        self.page_trees = {}
+        self.fallback_pages = None
+        self.root_tree = self.load_root()
+
+    def resolve_node(self, node, parent):
+        if isinstance(node, int):
+            objid = node
+            tree = dict_value(self.document.getobj(objid)).copy()
+        else:
+            objid = node.objid
+            tree = dict_value(node).copy()
+        for k, v in parent.iteritems():
+            if k in PDFPage.INHERITABLE_ATTRS and k not in tree:
+                tree[k] = v
+        return objid, tree
+
+    def load_fallback_pages(self):
+        if self.fallback_pages is None:
+            self.fallback_pages = list(PDFPage.create_pages(self.document))
+        return self.fallback_pages
+
+    def load_root(self):
+        catalog = self.document.catalog
+        if 'Pages' not in catalog:
+            return None
+        objid, tree = self.resolve_node(catalog['Pages'], catalog)
+        if tree.get('Type') is not LITERAL_PAGES or 'Kids' not in tree:
+            return None
+        return tree
+
+    def subtree_count(self, tree):
+        if tree.get('Type') is LITERAL_PAGE:
+            return 1
+        elif tree.get('Type') is LITERAL_PAGES and 'Kids' in tree:
+            if 'Count' in tree:
+                return int_value(tree['Count'])
+            return sum(self.subtree_count(self.resolve_node(kid, tree)[1]) for kid in list_value(tree['Kids']))
+        return 0
+
+    def __len__(self):
+        if self.root_tree is None:
+            return len(self.load_fallback_pages())
+        return self.subtree_count(self.root_tree)
+
+    def locate(self, page_n):
+        """
+        Walks down the page tree to a page. Every page leaf of each kid list resolved on the way is cached, not just
+        the ones before page_n, so reading a flat tree's pages in order resolves each kid once.
+        """
+        if page_n < 0:
+            return None
+        tree = self.root_tree
+        offset = 0
+        while tree is not None:
+            located = None
+            subtree = None
+            for kid in list_value(tree['Kids']):
+                objid, kid_tree = self.resolve_node(kid, tree)
+                if kid_tree.get('Type') is LITERAL_PAGE:
+                    self.page_trees[offset] = (objid, kid_tree)
+                    if offset == page_n:
+                        located = objid, kid_tree
+                    offset += 1
+                else:
+                    kid_count = self.subtree_count(kid_tree)
+                    if located is None and subtree is None and offset <= page_n < offset + kid_count:
+                        subtree = kid_tree, offset
+                    offset += kid_count
+            if located is not None:
+                return located
+            tree, offset = subtree if subtree is not None else (None, 0)
+        return None
+
+    def get_page(self, page_n):
+        """
+        :param page_n: zero indexed page number
+        :return: PDFPage, or None when the document has no such page
+        """
+        if self.root_tree is None:
+            pages = self.load_fallback_pages()
+            return pages[page_n] if 0 <= page_n < len(pages) else None
+        if page_n not in self.page_trees:
+            located = self.locate(page_n)
+            if located is None:
+                return None
+            self.page_trees[page_n] = located
+        objid, tree = self.page_trees[page_n]
+        return PDFPage(self.document, objid, tree)
+
+
+class PopplerPageIndex(object):
+    """
+    Same interface as PageIndex over a pdfparser poppler Document, whose pages are numbered from one.
+    """
+
+    def __init__(self, document):
+        self.document = document
+
+    def __len__(self):
+        return self.document.no_of_pages()
+
+    def get_page(self, page_n):
+        if 0 <= page_n < len(self):
+            return self.document.get_page(page_n + 1)
+        return None
+
+
+def count_pages(pdf_file):
+    with open(pdf_file, 'rb') as fp:
+        return len(PageIndex(PDFDocument(PDFParser(fp))))
+
+
+def get_page_mediaboxes(pdf_file):
+    with open(pdf_file, 'rb') as fp:
+        page_index = PageIndex(PDFDocument(PDFParser(fp)))
+        return [detach_pdf_object(page_index.get_page(page_n).mediabox) for page_n in range(len(page_index))]
+
+
+def get_page_mediabox(pdf_file, page_n, cache=None):
+    if cache is not None:
+        mediaboxes = cache.get_mediaboxes(pdf_file)
+        return mediaboxes[page_n] if 0 <= page_n < len(mediaboxes) else None
+    with open(pdf_file, 'rb') as fp:
+        page = PageIndex(PDFDocument(PDFParser(fp))).get_page(page_n)
+    return page.mediabox if page else None
+
+
+def detach_pdf_object(obj, seen=None):
+    """
+    Resolves any references back into the open PDFDocument so the object can be pickled on its own.
+    :param obj: pdfminer object, list or dict
+    :param seen: streams already detached, guards against reference cycles
+    :return: the detached object
+    """
+    if seen is None:
+        seen = set()
+    if isinstance(obj, PDFObjRef):
+        return detach_pdf_object(obj.resolve(), seen)
+    elif isinstance(obj, PDFStream):
+        if id(obj) not in seen:
+            seen.add(id(obj))
+            if obj.decipher:
+                obj.rawdata = obj.decipher(obj.objid, obj.genno, obj.rawdata)
+                obj.decipher = None
+            obj.attrs = detach_pdf_object(obj.attrs, seen)
+        return obj
+    elif isinstance(obj, list):
+        return [detach_pdf_object(v, seen) for v in obj]
+    elif isinstance(obj, dict):
+        return {k: detach_pdf_object(v, seen) for k, v in obj.items()}
+    return obj
+
+
+def detach_layout(layout):
+    if isinstance(layout, LTImage):
+        layout.stream = detach_pdf_object(layout.stream)
+        layout.colorspace = detach_pdf_object(layout.colorspace)
+    elif isinstance(layout, LTContainer):
+        for layout_ob in layout:
+            detach_layout(layout_ob)
+    return layout
+
+
+def iter_interpreted_pages(pdf_file, page_numbers, laparams, first_pageid=1, as_tables=False):
+    """
+    Runs pdfminer layout analysis over the listed pages of a single pdf, one page at a time.
+    :param pdf_file: path to pdf
+    :param page_numbers: ascending zero indexed page numbers to interpret
+    :param laparams: pdfminer LAParams, None leaves the page's characters ungrouped
+    :param first_pageid: pageid given to the first layout, matches the aggregator's own page counter
+    :param as_tables: convert each layout to a LayoutTable as soon as it is built
+    :return: generator of (page_n, layout) tuples in page order
+    """
+    with open(pdf_file, 'rb') as fp:
+        parser = PDFParser(fp)
+        document = PDFDocument(parser)
+        page_index = PageIndex(document)
+        rsrcmgr = PDFResourceManager()
+        device = PDFPageAggregator(rsrcmgr, pageno=first_pageid, laparams=laparams)
+        interpreter = PDFPageInterpreter(rsrcmgr, device)
+        for page_n in page_numbers:
+            page = page_index.get_page(page_n)
+            if page is None:
+                break
+            interpreter.process_page(page)
+            layout = device.get_result()
+            yield page_n, LayoutTable.from_pdfminer(layout) if as_tables else layout
+
+
+def interpret_pages(pdf_file, page_numbers, laparams, first_pageid=1, as_tables=False):
+    return list(iter_interpreted_pages(pdf_file, page_numbers, laparams, first_pageid, as_tables))
+
+
+def interpret_shard(shard):
+    pdf_file, page_numbers, laparams, first_pageid, as_tables = shard
+    return [(page_n, detach_layout(layout))
+            for page_n, layout in interpret_pages(pdf_file, page_numbers, laparams, first_pageid, as_tables)]
+
+
+def dump_raw_page(layout):
+    return pickle.dumps(detach_layout(layout), pickle.HIGHEST_PROTOCOL)
+
+
+def regroup_raw_page(raw_page, laparams, as_tables=False):
+    """
+    Runs only pdfminer's layout grouping over a page interpreted without LAParams.
+    :param raw_page: pickled, ungrouped LTPage from dump_raw_page
+    :param laparams: pdfminer LAParams to group with
+    :param as_tables: return a LayoutTable rather than the LTPage
+    :return: grouped layout, identical to interpreting the page with laparams
+    """
+    layout = pickle.loads(raw_page)
+    layout.analyze(laparams)
+    return LayoutTable.from_pdfminer(layout) if as_tables else layout
+
+
+class FigureDevice(PDFDevice):
+    """
+    Records the bbox of every top level figure on a page, the same boxes a PDFPageAggregator gives its LTFigures,
+    without building any other layout objects.
+    """
+
+    def __init__(self, rsrcmgr):
+        PDFDevice.__init__(self, rsrcmgr)
+        self.page_bbox = None
+        self.figure_bboxes = []
+        self.figure_depth = 0
+
+    def begin_page(self, page, ctm):
+        (x0, y0, x1, y1) = page.mediabox
+        (x0, y0) = apply_matrix_pt(ctm, (x0, y0))
+        (x1, y1) = apply_matrix_pt(ctm, (x1, y1))
+        self.page_bbox = (0, 0, abs(x0 - x1), abs(y0 - y1))
+        self.figure_bboxes = []
+        self.figure_depth = 0
+
+    def begin_figure(self, name, bbox, matrix):
+        if self.figure_depth == 0:
+            self.figure_bboxes.append(LTFigure(name, bbox, mult_matrix(matrix, self.ctm)).bbox)
+        self.figure_depth += 1
+
+    def end_figure(self, name):
+        self.figure_depth -= 1
+
+    def get_result(self):
+        return LayoutTable.from_rows(self.page_bbox, [], self.figure_bboxes)
+
+
+class FigureInterpreter(PDFPageInterpreter):
+    """
+    Content stream interpreter that only follows the graphics state and XObject placements. Fonts are never loaded,
+    text operators leave the device alone and form XObjects are placed without running their own contents.
+    """
+
+    def init_resources(self, resources):
+        resources = dict_value(resources)
+        PDFPageInterpreter.init_resources(self, {k: v for k, v in resources.items() if k != 'Font'})
+        self.resources = resources
+
+    def do_Tf(self, fontid, fontsize):
+        self.textstate.fontsize = fontsize
+
+    def do_TJ(self, seq):
+        return
+
+    def do_Do(self, xobjid):
+        xobjid = literal_name(xobjid)
+        try:
+            xobj = stream_value(self.xobjmap[xobjid])
+        except KeyError:
+            return
+        subtype = xobj.get('Subtype')
+        if subtype is LITERAL_FORM and 'BBox' in xobj:
+            bbox = list_value(xobj['BBox'])
+            matrix = list_value(xobj.get('Matrix', MATRIX_IDENTITY))
+            self.device.begin_figure(xobjid, bbox, matrix)
+            self.device.end_figure(xobjid)
+        elif subtype is LITERAL_IMAGE and 'Width' in xobj and 'Height' in xobj:
+            self.device.begin_figure(xobjid, (0, 0, 1, 1), MATRIX_IDENTITY)
+            self.device.end_figure(xobjid)
+
+
+def iter_page_figures(pdf_file, page_numbers):
+    """
+    Reads the figure placements of the listed pages straight from their content streams, with no text layout.
+    :param pdf_file: path to pdf
+    :param page_numbers: ascending zero indexed page numbers
+    :return: generator of (page_n, layout) tuples, each layout a LayoutTable of the page bbox and figure bboxes only
+    """
+    with open(pdf_file, 'rb') as fp:
+        page_index = PageIndex(PDFDocument(PDFParser(fp)))
+        rsrcmgr = PDFResourceManager()
+        device = FigureDevice(rsrcmgr)
+        interpreter = FigureInterpreter(rsrcmgr, device)
+        for page_n in page_numbers:
+            page = page_index.get_page(page_n)
+            if page is None:
+                break
+            interpreter.process_page(page)
+            yield page_n, device.get_result()
+
+
+def split_page_numbers(page_numbers, n_shards):
+    """
+    Splits page numbers into contiguous shards of near equal size.
+    :param page_numbers: ordered page numbers
+    :param n_shards: number of shards to make
+    :return: list of (first_position, shard_pages) tuples, first_position is the shard's offset in page_numbers
+    """
+    n_shards = max(1, min(n_shards, len(page_numbers)))
+    shard_size, remainder = divmod(len(page_numbers), n_shards)
+    shards = []
+    start = 0
+    for shard_n in range(n_shards):
+        stop = start + shard_size + (1 if shard_n < remainder else 0)
+        shards.append((start, page_numbers[start:stop]))
+        start = stop
+    return shards
+
+
+def resolve_page_numbers(pdf_file, page_range, cache=None):
+    n_pages = len(cache.get_mediaboxes(pdf_file)) if cache is not None else count_pages(pdf_file)
+    if page_range:
+        return range(max(page_range[0], 0), min(page_range[1] + 1, n_pages))
+    return range(n_pages)
+
+
+def iter_pooled_shards(shard_fn, shards, n_workers, max_in_flight):
+    """
+    Runs shard_fn over shards on a process pool, yielding each shard's result in order as soon as it is ready.
+    Only max_in_flight shards are queued at once, so memory stays bounded for long books.
+    """
+    shards = iter(shards)
+    pool = multiprocessing.Pool(n_workers)
+    in_flight = deque(pool.apply_async(shard_fn, (shard,)) for shard in islice(shards, max_in_flight))
+    try:
+        while in_flight:
+            shard_result = in_flight.popleft().get()
+            next_shard = next(shards, None)
+            if next_shard is not None:
+                in_flight.append(pool.apply_async(shard_fn, (next_shard,)))
+            yield shard_result
+    finally:
+        # terminating a py2 pool with results still in its pipes can hang, let the in flight shards finish instead
+        pool.close()
+        for pending in in_flight:
+            pending.wait()
+        pool.join()
+
+
+def count_shards(page_numbers, n_workers, shards_per_worker, max_shard_pages):
+    return max(n_workers * shards_per_worker, int(math.ceil(len(page_numbers) / float(max_shard_pages))))
+
+
+def iter_interpreted_page_numbers(pdf_file, page_numbers, laparams, n_workers=1, shards_per_worker=2,
+                                  as_tables=False, max_shard_pages=16):
+    """
+    Interprets pages in this process or across a process pool, yielding each page in order as soon as it is ready.
+    :return: generator of (page_n, layout) tuples in page order
+    """
+    if n_workers <= 1 or len(page_numbers) < 2:
+        for numbered_layout in iter_interpreted_pages(pdf_file, page_numbers, laparams, as_tables=as_tables):
+            yield numbered_layout
+        return
+
+    n_shards = count_shards(page_numbers, n_workers, shards_per_worker, max_shard_pages)
+    shards = [(pdf_file, shard_pages, laparams, first_position + 1, as_tables)
+              for first_position, shard_pages in split_page_numbers(page_numbers, n_shards)]
+    for shard_layouts in iter_pooled_shards(interpret_shard, shards, n_workers, n_workers * shards_per_worker):
+        for numbered_layout in shard_layouts:
+            yield numbered_layout
+
+
+class RawPageInterpreter(object):
+    """
+    Interprets single pages without layout analysis, opening the pdf on first use and keeping it open after.
+    """
+
+    def __init__(self, pdf_file):
+        self.pdf_file = pdf_file
+        self.fp = None
+        self.page_index = None
+        self.device = None
+        self.interpreter = None
+
+    def open(self):
+        self.fp = open(self.pdf_file, 'rb')
+        self.page_index = PageIndex(PDFDocument(PDFParser(self.fp)))
+        rsrcmgr = PDFResourceManager()
+        self.device = PDFPageAggregator(rsrcmgr, laparams=None)
+        self.interpreter = PDFPageInterpreter(rsrcmgr, self.device)
+
+    def get_raw_page(self, page_n):
+        """
+        :param page_n: zero indexed page number
+        :return: pickled, ungrouped LTPage or None when the pdf has no such page
+        """
+        if self.fp is None:
+            self.open()
+        page = self.page_index.get_page(page_n)
+        if page is None:
+            return None
+        self.interpreter.process_page(page)
+        return dump_raw_page(self.device.get_result())
+
+    def close(self):
+        if self.fp is not None:
+            self.fp.close()
+            self.fp = None
+
+
+class LayoutCache(object):
+    """
+    Persistent page layouts keyed by the pdf's content hash, the page number and every LAParams setting,
+    so renamed or copied books still hit and a layout is never reused under different grouping parameters.
+    LayoutTables are cached apart from full LTPage trees and are far cheaper to store and load.
+    Each page's ungrouped character stream is cached too, so a new LAParams setting only re-runs the grouping.
+    Figure-only tables from the content stream pass are kept under their own key, they do not depend on LAParams.
+    """
+
+    def __init__(self, cache_dir='pdf_layout_cache', max_bytes=2 * 1024 ** 3):
+        self.store = DiskCache(cache_dir, max_bytes, '.layout')
+
+    @classmethod
+    def laparams_key(cls, laparams):
+        return repr((laparams.line_overlap, laparams.char_margin, laparams.line_margin, laparams.word_margin,
+                     laparams.boxes_flow, laparams.detect_vertical, laparams.all_texts))
+
+    @classmethod
+    def layout_key(cls, pdf_hash, page_n, laparams, as_tables=False):
+        return '/'.join([pdf_hash, str(page_n), cls.laparams_key(laparams), 'table' if as_tables else 'ltpage'])
+
+    @classmethod
+    def raw_page_key(cls, pdf_hash, page_n):
+        return '/'.join([pdf_hash, str(page_n), 'raw'])
+
+    def get_mediaboxes(self, pdf_file):
+        key = file_digest(pdf_file) + '/mediaboxes'
+        mediaboxes = self.store.get_object(key)
+        if mediaboxes is None:
+            mediaboxes = get_page_mediaboxes(pdf_file)
+            self.store.put_object(key, mediaboxes)
+        return mediaboxes
+
+    def has_layout(self, pdf_file, page_n, laparams, as_tables=False):
+        return self.layout_key(file_digest(pdf_file), page_n, laparams, as_tables) in self.store
+
+    def get_layout(self, pdf_file, page_n, laparams, as_tables=False):
+        return self.store.get_object(self.layout_key(file_digest(pdf_file), page_n, laparams, as_tables))
+
+    def put_layout(self, pdf_file, page_n, laparams, layout):
+        as_tables = isinstance(layout, LayoutTable)
+        self.store.put_object(self.layout_key(file_digest(pdf_file), page_n, laparams, as_tables), detach_layout(layout))
+
+    def get_raw_page(self, pdf_file, page_n):
+        raw_page = self.store.get(self.raw_page_key(file_digest(pdf_file), page_n))
+        return zlib.decompress(raw_page) if raw_page is not None else None
+
+    def put_raw_page(self, pdf_file, page_n, raw_page):
+        self.store.put(self.raw_page_key(file_digest(pdf_file), page_n), zlib.compress(raw_page, 1))
+
+    @classmethod
+    def figures_key(cls, pdf_hash, page_n):
+        return '/'.join([pdf_hash, str(page_n), 'figures'])
+
+    def get_figures(self, pdf_file, page_n):
+        return self.store.get_object(self.figures_key(file_digest(pdf_file), page_n))
+
+    def put_figures(self, pdf_file, page_n, figures):
+        self.store.put_object(self.figures_key(file_digest(pdf_file), page_n), figures)
+
+
+def iter_regrouped_pages(pdf_file, page_numbers, laparams, cache, as_tables=False):
+    """
+    Groups each page from its cached character stream, interpreting and caching the stream first when missing.
+    :return: generator of (page_n, layout) tuples in page order
+    """
+    raw_interpreter = RawPageInterpreter(pdf_file)
+    try:
+        for page_n in page_numbers:
+            raw_page = cache.get_raw_page(pdf_file, page_n)
+            if raw_page is None:
+                raw_page = raw_interpreter.get_raw_page(page_n)
+                if raw_page is None:
+                    break
+                cache.put_raw_page(pdf_file, page_n, raw_page)
+            layout = regroup_raw_page(raw_page, laparams, as_tables)
+            cache.put_layout(pdf_file, page_n, laparams, layout)
+            yield page_n, layout
+    finally:
+        raw_interpreter.close()
+
+
+def regroup_shard(shard):
+    pdf_file, page_numbers, laparams, as_tables, cache_dir, max_bytes = shard
+    cache = LayoutCache(cache_dir, max_bytes)
+    return list(iter_regrouped_pages(pdf_file, page_numbers, laparams, cache, as_tables))
+
+
+def iter_regrouped_page_numbers(pdf_file, page_numbers, laparams, cache, n_workers=1, shards_per_worker=2,
+                                as_tables=False, max_shard_pages=16):
+    if n_workers <= 1 or len(page_numbers) < 2:
+        for numbered_layout in iter_regrouped_pages(pdf_file, page_numbers, laparams, cache, as_tables):
+            yield numbered_layout
+        return
+
+    n_shards = count_shards(page_numbers, n_workers, shards_per_worker, max_shard_pages)
+    shards = [(pdf_file, shard_pages, laparams, as_tables, cache.store.cache_dir, cache.store.max_bytes)
+              for _, shard_pages in split_page_numbers(page_numbers, n_shards)]
+    for shard_layouts in iter_pooled_shards(regroup_shard, shards, n_workers, n_workers * shards_per_worker):
+        for numbered_layout in shard_layouts:
+            yield numbered_layout
+
+
+def iter_cached_page_layouts(pdf_file, page_numbers, laparams, cache, n_workers=1, shards_per_worker=2,
+                             as_tables=False):
+    missing_pages = [page_n for page_n in page_numbers if not cache.has_layout(pdf_file, page_n, laparams, as_tables)]
+    regrouped_layouts = iter_regrouped_page_numbers(pdf_file, missing_pages, laparams, cache, n_workers,
+                                                    shards_per_worker, as_tables)
+    missing_pages = set(missing_pages)
+    for page_n in page_numbers:
+        if page_n in missing_pages:
+            _, layout = next(regrouped_layouts)
+        else:
+            layout = cache.get_layout(pdf_file, page_n, laparams, as_tables)
+            if layout is None:
+                # evicted by another process since the has_layout check
+                _, layout = next(iter_regrouped_pages(pdf_file, [page_n], laparams, cache, as_tables))
+        yield page_n, layout
+
+
+def iter_page_number_layouts(pdf_file, page_numbers, laparams, n_workers=1, shards_per_worker=2, cache=None,
+                             as_tables=False):
+    """
+    Like iter_page_layouts for an explicit, ordered list of page numbers, e.g. the pages a resumed job still needs.
+    :return: generator of (page_n, layout) tuples in page order
+    """
+    if cache is None:
+        return iter_interpreted_page_numbers(pdf_file, page_numbers, laparams, n_workers, shards_per_worker,
+                                             as_tables)
+    return iter_cached_page_layouts(pdf_file, page_numbers, laparams, cache, n_workers, shards_per_worker, as_tables)
+
+
+def iter_page_layouts(pdf_file, page_range, laparams, n_workers=1, shards_per_worker=2, cache=None,
+                      as_tables=False):
+    """
+    Streams pdfminer page layouts for a page range one page at a time, optionally sharding the range across a
+    process pool. Later pages are interpreted while earlier ones are being consumed.
+    :param pdf_file: path to pdf
+    :param page_range: inclusive [first, last] zero indexed page range, falsy for every page
+    :param laparams: pdfminer LAParams
+    :param n_workers: worker processes to use, 1 interprets the pages in this process
+    :param shards_per_worker: shards in flight per worker
+    :param cache: optional LayoutCache, pages missing from it are regrouped from their cached character stream
+                  or, failing that, interpreted
+    :param as_tables: yield compact LayoutTables rather than LTPage trees
+    :return: generator of (page_n, layout) tuples in page order
+    """
+    page_numbers = resolve_page_numbers(pdf_file, page_range, cache)
+    numbered_layouts = iter_page_number_layouts(pdf_file, page_numbers, laparams, n_workers, shards_per_worker, cache,
+                                                as_tables)
+    for position, (page_n, layout) in enumerate(numbered_layouts):
+        if not as_tables:
+            layout.pageid = position + 1
+        yield page_n, layout
+
+
+def iter_figure_layouts(pdf_file, page_range, cache=None):
+    """
+    Streams figure-only page tables for a page range, for callers that take their text from elsewhere and only
+    need figure bboxes. Much cheaper than iter_page_layouts, no fonts are loaded and no layout analysis is run.
+    :param pdf_file: path to pdf
+    :param page_range: inclusive [first, last] zero indexed page range, falsy for every page
+    :param cache: optional LayoutCache, pages missing from it are read from the pdf and cached
+    :return: generator of (page_n, LayoutTable) tuples in page order
+    """
+    page_numbers = resolve_page_numbers(pdf_file, page_range, cache)
+    if cache is None:
+        for numbered_figures in iter_page_figures(pdf_file, page_numbers):
+            yield numbered_figures
+        return
+
+    cached_figures = [(page_n, cache.get_figures(pdf_file, page_n)) for page_n in page_numbers]
+    read_figures = iter_page_figures(pdf_file, [page_n for page_n, figures in cached_figures if figures is None])
+    for page_n, figures in cached_figures:
+        if figures is None:
+            _, figures = next(read_figures)
+            cache.put_figures(pdf_file, page_n, figures)
+        yield page_n, figures
+
+
+def make_numbered_page_layouts(pdf_file, page_range, laparams, n_workers=1, shards_per_worker=2, cache=None,
+                               as_tables=False):
+    return list(iter_page_layouts(pdf_file, page_range, laparams, n_workers, shards_per_worker, cache, as_tables))
+
+
+def make_page_layouts(pdf_file, page_range, laparams, n_workers=1, cache=None, as_tables=False):
+    return [layout for _, layout in iter_page_layouts(pdf_file, page_range, laparams, n_workers,
+                                                      cache=cache, as_tables=as_tables)]
+
+
+def sweep_page_layouts(pdf_file, page_range, laparams_grid, cache, n_workers=1, as_tables=False):
+    """
+    Lays out a page range under each LAParams setting in turn. The pdf is interpreted once, into the cache's
+    character streams, and every later setting only re-runs the grouping step.
+    :param laparams_grid: iterable of pdfminer LAParams
+    :param cache: LayoutCache holding the character streams, a throwaway cache dir works for one-off sweeps
+    :return: generator of (laparams, [(page_n, layout), ...]) tuples
+    """
+    for laparams in laparams_grid:
+        yield laparams, make_numbered_page_layouts(pdf_file, page_range, laparams, n_workers, cache=cache,
+                                                   as_tables=as_tables)
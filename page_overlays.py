@@ -0,0 +1,168 @@
+import os
+
+import numpy as np
+import cv2
+
+from layout_table import LayoutTable
+from page_layouts import LayoutCache, iter_page_layouts, resolve_page_numbers, split_page_numbers, count_shards
+from page_layouts import iter_pooled_shards
+from page_rasters import render_page_array
+
+
+def layout_bboxes(page_layout):
+    """
+    :param page_layout: pdfminer LTPage or LayoutTable
+    :return: float64 array of shape (n, 4) holding the bbox of every top level object, or every line and figure
+    """
+    if isinstance(page_layout, LayoutTable):
+        return np.vstack([page_layout.line_bboxes, page_layout.figure_bboxes])
+    return np.array([layout_ob.bbox for layout_ob in page_layout], dtype=np.float64).reshape(-1, 4)
+
+
+def layout_height(page_layout):
+    if isinstance(page_layout, LayoutTable):
+        return page_layout.page_bbox[3] - page_layout.page_bbox[1]
+    return page_layout.height
+
+
+def to_pixel_boxes(bboxes, page_height, scale):
+    """
+    Converts pdf bboxes, y measured up from the page bottom, into image pixel boxes measured down from the top.
+    :param bboxes: array of shape (n, 4) of (x0, y0, x1, y1) in pdf points
+    :param page_height: page height in pdf points
+    :param scale: pixels per pdf point
+    :return: int32 array of shape (n, 4) of (left, top, right, bottom) pixels
+    """
+    pixel_boxes = np.empty_like(bboxes)
+    pixel_boxes[:, 0] = bboxes[:, 0] * scale
+    pixel_boxes[:, 1] = (page_height - bboxes[:, 3]) * scale
+    pixel_boxes[:, 2] = bboxes[:, 2] * scale
+    pixel_boxes[:, 3] = (page_height - bboxes[:, 1]) * scale
+    return pixel_boxes.astype(np.int32)
+
+
+def draw_layout_overlay(page_img, page_layout, thickness=2, seed=None):
+    """
+    :param page_img: RGB uint8 page array, copied first if read only
+    :param page_layout: pdfminer LTPage or LayoutTable of the same page
+    :param seed: seed for the box colours, fixed seeds give the same colours on every run
+    :return: page array with every layout box outlined
+    """
+    if not page_img.flags.writeable:
+        page_img = page_img.copy()
+    page_height = layout_height(page_layout)
+    pixel_boxes = to_pixel_boxes(layout_bboxes(page_layout), page_height, page_img.shape[0] / float(page_height))
+    colors = np.random.RandomState(seed).randint(0, 256, size=(len(pixel_boxes), 3))
+    for (left, top, right, bottom), color in zip(pixel_boxes.tolist(), colors.tolist()):
+        cv2.rectangle(page_img, (left, top), (right, bottom), color=tuple(color), thickness=thickness)
+    return page_img
+
+
+def overlay_file_name(book_name, page_n):
+    return book_name + '_' + str(page_n) + '.png'
+
+
+def iter_shard_overlays(shard):
+    """
+    Lays out, renders and outlines a contiguous run of pages.
+    :return: generator of (page_n, result) tuples, result is the written file's path when dest_dir is set,
+             else the overlay array
+    """
+    pdf_file, page_numbers, laparams, dpi, dest_dir, cache_dir, max_bytes = shard
+    cache = LayoutCache(cache_dir, max_bytes) if cache_dir else None
+    book_name = os.path.basename(pdf_file).replace('.pdf', '')
+    for page_n, page_layout in iter_page_layouts(pdf_file, [page_numbers[0], page_numbers[-1]], laparams, cache=cache):
+        overlay = draw_layout_overlay(render_page_array(pdf_file, page_n, dpi), page_layout, seed=page_n)
+        if dest_dir:
+            overlay_path = os.path.join(dest_dir, overlay_file_name(book_name, page_n))
+            cv2.imwrite(overlay_path, cv2.cvtColor(overlay, cv2.COLOR_RGB2BGR))
+            yield page_n, overlay_path
+        else:
+            yield page_n, overlay
+
+
+def overlay_shard(shard):
+    return list(iter_shard_overlays(shard))
+
+
+def iter_page_overlays(pdf_file, page_range, laparams, dpi=72, dest_dir=None, n_workers=1, shards_per_worker=2,
+                       cache=None, max_shard_pages=8):
+    """
+    Renders layout overlays for a page range, each worker laying out, rendering and outlining its own pages.
+    :param pdf_file: path to pdf
+    :param page_range: inclusive [first, last] zero indexed page range, falsy for every page
+    :param laparams: pdfminer LAParams
+    :param dpi: render resolution
+    :param dest_dir: directory to write <book>_<page_n>.png overlays to, None yields the arrays instead
+    :param n_workers: worker processes to use, 1 renders in this process
+    :param cache: optional LayoutCache the workers share
+    :return: generator of (page_n, path or RGB array) tuples in page order
+    """
+    if dest_dir and not os.path.isdir(dest_dir):
+        os.makedirs(dest_dir)
+    cache_dir, max_bytes = (cache.store.cache_dir, cache.store.max_bytes) if cache is not None else (None, None)
+    page_numbers = resolve_page_numbers(pdf_file, page_range, cache)
+    if not page_numbers:
+        return
+    if n_workers <= 1:
+        shard_results = [iter_shard_overlays((pdf_file, page_numbers, laparams, dpi, dest_dir, cache_dir, max_bytes))]
+    else:
+        n_shards = count_shards(page_numbers, n_workers, shards_per_worker, max_shard_pages)
+        shards = [(pdf_file, shard_pages, laparams, dpi, dest_dir, cache_dir, max_bytes)
+                  for _, shard_pages in split_page_numbers(page_numbers, n_shards)]
+        shard_results = iter_pooled_shards(overlay_shard, shards, n_workers, n_workers * shards_per_worker)
+    for numbered_overlays in shard_results:
+        for numbered_overlay in numbered_overlays:
+            yield numbered_overlay
+
+
+def write_page_overlays(pdf_file, page_range, laparams, dest_dir, dpi=72, n_workers=1, cache=None):
+    return [overlay_path for _, overlay_path in iter_page_overlays(pdf_file, page_range, laparams, dpi, dest_dir,
+                                                                   n_workers, cache=cache)]
+
+
+def tile_contact_sheet(page_imgs, n_cols, background=255):
+    """
+    :param page_imgs: RGB page arrays, padded to the largest page so pages of mixed sizes line up
+    :param n_cols: pages per row
+    :return: single RGB array with the pages laid out left to right, top to bottom
+    """
+    cell_height = max(page_img.shape[0] for page_img in page_imgs)
+    cell_width = max(page_img.shape[1] for page_img in page_imgs)
+    n_rows = -(-len(page_imgs) // n_cols)
+    sheet = np.full((n_rows * cell_height, n_cols * cell_width, 3), background, dtype=np.uint8)
+    for img_n, page_img in enumerate(page_imgs):
+        top = (img_n // n_cols) * cell_height
+        left = (img_n % n_cols) * cell_width
+        sheet[top:top + page_img.shape[0], left:left + page_img.shape[1]] = page_img
+    return sheet
+
+
+def write_contact_sheets(pdf_file, page_range, laparams, dest_dir, dpi=24, n_cols=6, n_rows=4, n_workers=1,
+                         cache=None):
+    """
+    Tiles low resolution layout overlays of a page range into contact sheets for skimming whole books.
+    :param dpi: render resolution of each page, 24 gives pages about 200 pixels wide
+    :param n_cols: pages per sheet row
+    :param n_rows: rows per sheet
+    :return: list of written <book>_sheet_<n>.png paths
+    """
+    if not os.path.isdir(dest_dir):
+        os.makedirs(dest_dir)
+    book_name = os.path.basename(pdf_file).replace('.pdf', '')
+    sheet_paths = []
+    sheet_pages = []
+
+    def write_sheet():
+        sheet_path = os.path.join(dest_dir, book_name + '_sheet_' + str(len(sheet_paths)) + '.png')
+        cv2.imwrite(sheet_path, cv2.cvtColor(tile_contact_sheet(sheet_pages, n_cols), cv2.COLOR_RGB2BGR))
+        sheet_paths.append(sheet_path)
+
+    for _, overlay in iter_page_overlays(pdf_file, page_range, laparams, dpi, None, n_workers, cache=cache):
+        sheet_pages.append(overlay)
+        if len(sheet_pages) == n_cols * n_rows:
+            write_sheet()
+            del sheet_pages[:]
+    if sheet_pages:
+        write_sheet()
+    return sheet_paths
@@ -0,0 +1,147 @@
+import numpy as np
+from wand.image import Image as WImage
+
+from disk_cache import DiskCache, file_digest
+from page_layouts import resolve_page_numbers, split_page_numbers, count_shards, iter_pooled_shards
+
+
+def render_page(pdf_file, page_n, dpi):
+    """
+    :param pdf_file: path to pdf
+    :param page_n: zero indexed page number
+    :param dpi: render resolution, 72 maps one pdf point to one pixel
+    :return: PNG bytes of the rendered page
+    """
+    with WImage(filename='{}[{}]'.format(pdf_file, page_n), resolution=dpi) as page_img:
+        return page_img.make_blob('png')
+
+
+def render_page_array(pdf_file, page_n, dpi):
+    """
+    Renders a page straight to 8 bit RGB pixels, no image format is encoded or decoded on the way.
+    :return: uint8 array of shape (height, width, 3), a read only view of Wand's pixel blob
+    """
+    with WImage(filename='{}[{}]'.format(pdf_file, page_n), resolution=dpi) as page_img:
+        page_img.depth = 8
+        pixels = page_img.make_blob('RGB')
+        return np.frombuffer(pixels, dtype=np.uint8).reshape(page_img.height, page_img.width, 3)
+
+
+class RasterCache(object):
+    """
+    Rendered pages as PNG files keyed by the pdf's content hash, the page number and the render DPI.
+    Entries are plain PNGs, so the path of a cached page can be handed straight to PIL or OpenCV.
+    """
+
+    def __init__(self, cache_dir='pdf_raster_cache', max_bytes=4 * 1024 ** 3):
+        self.store = DiskCache(cache_dir, max_bytes, '.png')
+
+    @classmethod
+    def page_key(cls, pdf_hash, page_n, dpi):
+        return '/'.join([pdf_hash, str(page_n), str(dpi)])
+
+    def has_page(self, pdf_file, page_n, dpi):
+        return self.page_key(file_digest(pdf_file), page_n, dpi) in self.store
+
+    def get_page(self, pdf_file, page_n, dpi):
+        return self.store.get(self.page_key(file_digest(pdf_file), page_n, dpi))
+
+    def put_page(self, pdf_file, page_n, dpi, page_png):
+        return self.store.put(self.page_key(file_digest(pdf_file), page_n, dpi), page_png)
+
+    def page_path(self, pdf_file, page_n, dpi):
+        """
+        :return: path of the cached PNG for a page, rendering the page first if it is not cached
+        """
+        key = self.page_key(file_digest(pdf_file), page_n, dpi)
+        if key not in self.store:
+            return self.store.put(key, render_page(pdf_file, page_n, dpi))
+        return self.store.path_for(key)
+
+
+def render_shard(shard):
+    pdf_file, page_numbers, dpi, cache_dir, max_bytes = shard
+    cache = RasterCache(cache_dir, max_bytes)
+    for page_n in page_numbers:
+        cache.put_page(pdf_file, page_n, dpi, render_page(pdf_file, page_n, dpi))
+    return page_numbers
+
+
+def iter_rendered_page_numbers(pdf_file, page_numbers, dpi, cache, n_workers=1, shards_per_worker=2,
+                               max_shard_pages=16):
+    """
+    Renders pages into the cache in this process or across a process pool.
+    :return: generator of page numbers in order, each yielded once its page is in the cache
+    """
+    if n_workers <= 1 or len(page_numbers) < 2:
+        for page_n in page_numbers:
+            cache.put_page(pdf_file, page_n, dpi, render_page(pdf_file, page_n, dpi))
+            yield page_n
+        return
+
+    n_shards = count_shards(page_numbers, n_workers, shards_per_worker, max_shard_pages)
+    shards = [(pdf_file, shard_pages, dpi, cache.store.cache_dir, cache.store.max_bytes)
+              for _, shard_pages in split_page_numbers(page_numbers, n_shards)]
+    for shard_pages in iter_pooled_shards(render_shard, shards, n_workers, n_workers * shards_per_worker):
+        for page_n in shard_pages:
+            yield page_n
+
+
+def rasterize_pages(pdf_file, page_range, dpi, cache, n_workers=1, shards_per_worker=2):
+    """
+    Fills the cache with renders of a page range, skipping pages that are already cached at this DPI.
+    :param pdf_file: path to pdf
+    :param page_range: inclusive [first, last] zero indexed page range, falsy for every page
+    :param dpi: render resolution
+    :param cache: RasterCache to fill
+    :param n_workers: worker processes to render with, 1 renders in this process
+    :return: list of the page numbers that had to be rendered
+    """
+    page_numbers = resolve_page_numbers(pdf_file, page_range)
+    missing_pages = [page_n for page_n in page_numbers if not cache.has_page(pdf_file, page_n, dpi)]
+    return list(iter_rendered_page_numbers(pdf_file, missing_pages, dpi, cache, n_workers, shards_per_worker))
+
+
+def iter_page_rasters(pdf_file, page_range, dpi, cache, n_workers=1, shards_per_worker=2):
+    """
+    Streams rendered pages for a page range, rendering the pages missing from the cache while earlier ones
+    are being consumed.
+    :return: generator of (page_n, PNG bytes) tuples in page order
+    """
+    page_numbers = resolve_page_numbers(pdf_file, page_range)
+    missing_pages = [page_n for page_n in page_numbers if not cache.has_page(pdf_file, page_n, dpi)]
+    rendered_pages = iter_rendered_page_numbers(pdf_file, missing_pages, dpi, cache, n_workers, shards_per_worker)
+    missing_pages = set(missing_pages)
+    for page_n in page_numbers:
+        if page_n in missing_pages:
+            next(rendered_pages)
+        page_png = cache.get_page(pdf_file, page_n, dpi)
+        if page_png is None:
+            # evicted since it was rendered or checked
+            page_png = render_page(pdf_file, page_n, dpi)
+            cache.put_page(pdf_file, page_n, dpi, page_png)
+        yield page_n, page_png
+
+
+def render_array_shard(shard):
+    pdf_file, page_numbers, dpi = shard
+    return [(page_n, render_page_array(pdf_file, page_n, dpi)) for page_n in page_numbers]
+
+
+def iter_page_arrays(pdf_file, page_range, dpi, n_workers=1, shards_per_worker=2, max_shard_pages=4):
+    """
+    Streams raw RGB page arrays for a page range, bypassing the PNG cache. Meant for interactive previews,
+    where encoding every page only to decode it again costs more than rendering it.
+    :return: generator of (page_n, uint8 array) tuples in page order
+    """
+    page_numbers = resolve_page_numbers(pdf_file, page_range)
+    if n_workers <= 1 or len(page_numbers) < 2:
+        for page_n in page_numbers:
+            yield page_n, render_page_array(pdf_file, page_n, dpi)
+        return
+
+    n_shards = count_shards(page_numbers, n_workers, shards_per_worker, max_shard_pages)
+    shards = [(pdf_file, shard_pages, dpi) for _, shard_pages in split_page_numbers(page_numbers, n_shards)]
+    for shard_arrays in iter_pooled_shards(render_array_shard, shards, n_workers, n_workers * shards_per_worker):
+        for numbered_array in shard_arrays:
+            yield numbered_array
@@ -0,0 +1,96 @@
+import re
+
+import numpy as np
+
+from page_layouts import iter_page_number_layouts
+
+
+TEXT_LAYER_SCORE = 1.0
+
+# pdfminer writes glyphs it cannot map to unicode as (cid:n), or as the replacement character
+UNMAPPED_GLYPH = re.compile(u'\\(cid:\\d+\\)|\ufffd', re.UNICODE)
+
+
+def text_layer_stats(table):
+    """
+    :param table: LayoutTable of the page
+    :return: (mapped, unmapped) counts of the text layer's non-space characters
+    """
+    n_unmapped = len(UNMAPPED_GLYPH.findall(table.text))
+    n_mapped = len(u''.join(UNMAPPED_GLYPH.sub(u'', table.text).split()))
+    return n_mapped, n_unmapped
+
+
+def has_usable_text_layer(table, min_chars=50, min_mapped=0.95):
+    """
+    A page's text layer is usable when it carries at least min_chars characters and at least min_mapped of its
+    glyphs map to unicode. Scanned pages have no text lines at all, and pages with broken font encodings come
+    out as (cid:n) runs, both go to OCR instead.
+    """
+    n_mapped, n_unmapped = text_layer_stats(table)
+    return n_mapped >= min_chars and n_mapped >= min_mapped * (n_mapped + n_unmapped)
+
+
+def page_to_image_boxes(bboxes, page_bbox, image_size):
+    """
+    Scales pdf boxes, measured in points with y up from the page bottom, onto a page image of image_size pixels
+    with y down from the top.
+    :param bboxes: array-like of shape (n, 4) of (x0, y0, x1, y1) pdf boxes
+    :param page_bbox: (x0, y0, x1, y1) of the page the image was rendered from
+    :param image_size: (width, height) of the page image
+    :return: int array of shape (n, 4) of (left, top, right, bottom) pixel boxes, clipped to the image
+    """
+    page_x0, page_y0, page_x1, page_y1 = page_bbox
+    x_scale = image_size[0] / float(page_x1 - page_x0)
+    y_scale = image_size[1] / float(page_y1 - page_y0)
+    bboxes = np.asarray(bboxes, dtype=np.float64).reshape(-1, 4)
+    pixel_boxes = np.column_stack([(bboxes[:, 0] - page_x0) * x_scale,
+                                   (page_y1 - bboxes[:, 3]) * y_scale,
+                                   (bboxes[:, 2] - page_x0) * x_scale,
+                                   (page_y1 - bboxes[:, 1]) * y_scale])
+    limits = np.array([image_size[0], image_size[1], image_size[0], image_size[1]])
+    return np.clip(np.rint(pixel_boxes), 0, limits).astype(int)
+
+
+def text_layer_response(table, image_size):
+    """
+    Turns a page's text lines into the response shape of the vision-ocr service, so write_annotation_file and
+    everything downstream of it treat text layer pages exactly like OCRed ones.
+    :param table: LayoutTable of the page
+    :param image_size: (width, height) of the page image the annotation refers to
+    :return: dict with the page's non-blank lines as detections
+    """
+    pixel_boxes = page_to_image_boxes(table.line_bboxes, table.page_bbox, image_size)
+    detections = []
+    for line_n, (left, top, right, bottom) in enumerate(pixel_boxes.tolist()):
+        value = u' '.join(table.line_text(line_n).split())
+        if value:
+            detections.append({
+                'value': value,
+                'score': TEXT_LAYER_SCORE,
+                'rectangle': [{'x': left, 'y': top}, {'x': right, 'y': bottom}]
+            })
+    return {'detections': detections}
+
+
+def figure_image_boxes(table, image_size, min_size=32):
+    """
+    :param table: LayoutTable of the page
+    :param image_size: (width, height) of the page image
+    :param min_size: figures narrower or shorter than this many pixels on the page image are skipped
+    :return: list of (left, top, right, bottom) pixel boxes of the page's figures
+    """
+    pixel_boxes = page_to_image_boxes(table.figure_bboxes, table.page_bbox, image_size)
+    return [tuple(box) for box in pixel_boxes.tolist()
+            if box[2] - box[0] >= min_size and box[3] - box[1] >= min_size]
+
+
+def iter_text_layer_tables(pdf_file, page_numbers, laparams, n_workers=1, cache=None, min_chars=50, min_mapped=0.95):
+    """
+    :param page_numbers: ordered page numbers to check
+    :param cache: optional LayoutCache
+    :return: generator of (page_n, LayoutTable) tuples for the pages with a usable text layer, None for the others
+    """
+    for page_n, table in iter_page_number_layouts(pdf_file, page_numbers, laparams, n_workers, cache=cache,
+                                                  as_tables=True):
+        yield page_n, table if has_usable_text_layer(table, min_chars, min_mapped) else None